@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Bandwidth limits for the transfers: a token bucket for the whole client,
+one per job, an optional schedule of the client limit over the day, and
+the measure of the throughput actually sustained.
+
+Kept free of Qt and OMERO imports. Nothing here sleeps on the GUI thread:
+consume() returns how long to wait, the download generator yields it and
+the GUI steps it again after that delay.
+"""
+
+import math
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+MB = 1000000
+
+
+class TokenBucket:
+    """Allows rate bytes per second on average and bursts of burst bytes.
+
+    A chunk larger than the bucket is let through and paid for afterwards,
+    the bucket goes into debt and consume() returns the time to repay it.
+    A rate of None means no limit.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate or None
+            self.burst = burst or self.rate or 0  # one second worth by default
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self, nbytes):
+        """Takes nbytes, returns the seconds to wait before the next transfer"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.rate is None:
+                return 0.0
+            self._tokens -= nbytes
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class BandwidthSchedule:
+    """Client limit by time of day, e.g. capped during the day only.
+
+    Parsed from rules like "08:00-18:00=5, 18:00-08:00=0" in MB/s, 0 being
+    unlimited. A window may wrap around midnight, the first matching rule
+    wins and outside all of them the default rate applies.
+    """
+
+    def __init__(self, rules=(), default=None):
+        self.rules = list(rules)  # [(start minute, end minute, bytes/s or None)]
+        self.default = default
+
+    @classmethod
+    def parse(cls, text, default=None):
+        rules = []
+        for rule in filter(None, (r.strip() for r in text.split(','))):
+            try:
+                window, rate = rule.split('=')
+                start, end = (cls._minutes(t) for t in window.split('-'))
+                rate = float(rate)
+            except ValueError:
+                raise ValueError(f"Invalid bandwidth rule '{rule}', expected HH:MM-HH:MM=MB/s")
+            if not math.isfinite(rate) or rate < 0:
+                raise ValueError(f"Invalid bandwidth rule '{rule}', the rate must be a finite number of MB/s, 0 or more")
+            rules.append((start, end, int(rate * MB) or None))
+        return cls(rules, default)
+
+    @staticmethod
+    def _minutes(text):
+        hours, minutes = text.strip().split(':')
+        hours, minutes = int(hours), int(minutes)
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise ValueError(text)
+        return hours * 60 + minutes
+
+    def rate_at(self, when=None):
+        when = when or datetime.now()
+        minute = when.hour * 60 + when.minute
+        for start, end, rate in self.rules:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end  # over midnight
+            if inside:
+                return rate
+        return self.default
+
+
+class ThroughputMeter:
+    """Bytes transferred, as an average and over the last seconds"""
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.total = 0
+        self.started = time.monotonic()
+        self._samples = deque()  # [(time, bytes)]
+
+    def add(self, nbytes):
+        now = time.monotonic()
+        self.total += nbytes
+        self._samples.append((now, nbytes))
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+    def current(self):
+        """Bytes per second over the window"""
+        if not self._samples:
+            return 0.0
+        elapsed = max(time.monotonic() - self._samples[0][0], 1.0)
+        return sum(nbytes for _, nbytes in self._samples) / min(elapsed, self.window)
+
+    def average(self):
+        """Bytes per second since the start"""
+        return self.total / max(time.monotonic() - self.started, 1e-6)
+
+
+class BandwidthLimiter:
+    """The client bucket, shared by every job, and the one of a single job.
+
+    The client rate follows the schedule, it is looked up again at most
+    every minute.
+    """
+
+    def __init__(self, client_bucket, schedule, job_rate=None):
+        self.client_bucket = client_bucket
+        self.schedule = schedule
+        self.job_bucket = TokenBucket(job_rate)
+        self.meter = ThroughputMeter()
+        self._checked = 0.0
+
+    def _update_client_rate(self):
+        now = time.monotonic()
+        if now - self._checked < 60:
+            return
+        self._checked = now
+        rate = self.schedule.rate_at()
+        if rate != self.client_bucket.rate:
+            self.client_bucket.set_rate(rate)
+
+    def limit(self):
+        """Effective limit in bytes per second, None if unlimited"""
+        self._update_client_rate()
+        rates = [r for r in (self.client_bucket.rate, self.job_bucket.rate) if r]
+        return min(rates) if rates else None
+
+    def chunk_size(self, default):
+        """Smaller reads under a low limit, for an even pace and progress"""
+        limit = self.limit()
+        if limit is None:
+            return default
+        return max(65536, min(default, limit // 4))
+
+    def consume(self, nbytes):
+        """Records a transfer, returns the seconds to wait before the next one"""
+        self._update_client_rate()
+        self.meter.add(nbytes)
+        return max(self.client_bucket.consume(nbytes), self.job_bucket.consume(nbytes))
+
+    def wait(self, nbytes):
+        """Blocking consume(), for worker threads"""
+        delay = self.consume(nbytes)
+        if delay:
+            time.sleep(delay)
+
+
+def format_rate(rate):
+    return "unlimited" if rate is None else f"{rate / MB:.1f} MB/s"
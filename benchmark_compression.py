@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the effect of Ice compression on loading the tree and on downloads.
+
+Every mode connects to the same session, lists all the projects, datasets
+and images of the user like the OMERO tree, then reads the files of an
+image without writing them. The modes are run in turns, so a slow moment
+of the server or the network does not favour one of them, and the median
+of the repeats is reported.
+
+    python benchmark_compression.py HOST PORT TOKEN --image 1234
+
+Run it from where the users are (home, VPN, LAN) and pick the mode per
+server in Settings > Configure.
+"""
+
+import sys
+import time
+import argparse
+from statistics import median
+
+import omero_connection
+from bandwidth import MB
+
+
+def load_tree(conn):
+    """Same calls as the OMERO tree, returns the number of images"""
+    count = 0
+    for project_id in conn.get_user_projects():
+        for dataset_id in conn.get_dataset_from_projectID(project_id):
+            count += len(conn.get_images_from_datasetID(dataset_id))
+    return count
+
+
+def read_image_files(conn, image_id, max_bytes):
+    """Reads the fileset of the image, at most max_bytes, returns the bytes read"""
+    fileset = conn.get_fileset_from_imageID(image_id)
+    if fileset is None:
+        raise ValueError(f"No fileset for image {image_id}")
+    total = 0
+    for orig_file in fileset.listFiles():
+        chunks = conn.get_file_in_chunks(orig_file.getId(), orig_file.getSize())
+        try:
+            for chunk in chunks:
+                total += len(chunk)
+                if total >= max_bytes:
+                    return total
+        finally:
+            chunks.close()
+    return total
+
+
+# (metadata, transfers) compressed in each mode
+EXPECTED = {
+    omero_connection.COMPRESS_OFF: (False, False),
+    omero_connection.COMPRESS_METADATA: (True, False),
+    omero_connection.COMPRESS_ALL: (True, True),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("host")
+    parser.add_argument("port")
+    parser.add_argument("token", help="OMERO session token")
+    parser.add_argument("--image", type=int, help="image whose files are downloaded")
+    parser.add_argument("--max-mb", type=float, default=200, help="stop each download after this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", default=",".join(omero_connection.COMPRESSION_MODES))
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in omero_connection.COMPRESSION_MODES:
+            sys.exit(f"Unknown mode {mode}, expected one of {omero_connection.COMPRESSION_MODES}")
+
+    tree_times = {mode: [] for mode in modes}
+    rates = {mode: [] for mode in modes}
+    images = 0
+    for run in range(args.repeat):
+        for mode in modes:
+            conn = omero_connection.OmeroConnection(args.host, args.port, args.token, mode)
+            try:
+                # Otherwise the modes would compare identical setups
+                in_effect = conn.get_compression_in_effect()
+                if in_effect != EXPECTED[mode]:
+                    sys.exit(f"Compression {mode}: (metadata, transfers) compressed is "
+                             f"{in_effect} instead of {EXPECTED[mode]}")
+                start = time.perf_counter()
+                images = load_tree(conn)
+                tree_times[mode].append(time.perf_counter() - start)
+                if args.image is not None:
+                    start = time.perf_counter()
+                    size = read_image_files(conn, args.image, args.max_mb * MB)
+                    rates[mode].append(size / (time.perf_counter() - start))
+            finally:
+                conn._close_omero_connection()  # leaves the session, does not kill it
+            print(f"run {run + 1}/{args.repeat} {mode} done", file=sys.stderr)
+
+    print(f"{args.host}, {images} images, median of {args.repeat} runs")
+    print(f"{'Compression':<12}{'tree load [s]':>16}{'download [MB/s]':>18}")
+    for mode in modes:
+        rate = f"{median(rates[mode]) / MB:.1f}" if rates[mode] else "-"
+        print(f"{mode:<12}{median(tree_times[mode]):>16.2f}{rate:>18}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Record of the files downloaded in a directory, and its verification.
+
+Kept free of Qt and OMERO imports: the verification hashes files on a
+process pool and the workers import this module.
+
+Verify a download directory from the command line with:
+    python download_index.py path/to/downloads
+"""
+
+import sys
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# OMERO checksum algorithms that can be computed locally
+HASHERS = {
+    'SHA1-160': hashlib.sha1,
+    'MD5-128': hashlib.md5,
+}
+
+
+class DownloadIndex:
+    """Records the OriginalFiles already present in a download directory.
+
+    Kept as one JSON line per file in the download directory itself, so that
+    a file seen again, by OriginalFile id or by server hash, can be linked
+    locally instead of being transferred again. Only the hashes of HASHERS
+    identify a content: OMERO also records weak checksums, or only the size
+    with File-Size-64, which different files can share.
+    """
+    FILE_NAME = ".omero_download_index.jsonl"
+
+    def __init__(self, base_path):
+        self.base_path = Path(base_path)
+        self.index_path = self.base_path / self.FILE_NAME
+        self._by_id = {}    # {file_id: entry}
+        self._by_hash = {}  # {(hasher, hash): entry}
+        self._by_path = {}  # {relative path: entry}
+        self._load()
+
+    def exists(self):
+        return self.index_path.exists()
+
+    def _load(self):
+        if not self.index_path.exists():
+            return
+        with open(self.index_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._remember(json.loads(line))
+                except ValueError:
+                    continue  # last line cut short by a crash
+
+    def _remember(self, entry):
+        self._by_id[entry['id']] = entry
+        self._by_path[entry['path']] = entry
+        if entry['hash'] and entry.get('hasher') in HASHERS:
+            self._by_hash[(entry['hasher'], entry['hash'].lower())] = entry
+
+    def entries(self):
+        """The latest entry for every downloaded path"""
+        return list(self._by_path.values())
+
+    def find(self, file_id, file_hash, file_size, hasher=None):
+        """Returns the path of an identical local file, None if there is none"""
+        candidates = [self._by_id.get(file_id)]
+        if file_hash and hasher in HASHERS:
+            candidates.append(self._by_hash.get((hasher, file_hash.lower())))
+        for entry in candidates:
+            if entry is None or entry['size'] != file_size:
+                continue
+            path = self.base_path / entry['path']
+            try:
+                if path.stat().st_size == file_size:
+                    return path
+            except OSError:
+                pass  # removed or moved since
+        return None
+
+    def add(self, file_id, file_hash, file_size, path, hasher=None, group_id=None):
+        entry = {
+            'id': file_id,
+            'hash': file_hash,
+            'hasher': hasher,
+            'size': file_size,
+            'group': group_id,
+            'path': Path(path).relative_to(self.base_path).as_posix(),
+        }
+        self._remember(entry)
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def hash_file(path, hasher_name, buf=4194304):
+    hasher = HASHERS[hasher_name]()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(buf), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class VerifyReport:
+    def __init__(self):
+        self.ok = []
+        self.missing = []
+        self.truncated = []
+        self.corrupted = []
+        self.unchecked = []  # right size, but no checksum we can compute
+
+    def bad_entries(self):
+        return self.missing + self.truncated + self.corrupted
+
+    def summary(self):
+        return (f"{len(self.ok)} files OK\n"
+                f"{len(self.missing)} missing\n"
+                f"{len(self.truncated)} truncated\n"
+                f"{len(self.corrupted)} corrupted\n"
+                f"{len(self.unchecked)} not checked (no supported checksum)")
+
+
+def verify_generator(index, report, workers=None):
+    """Checks every indexed file, yields (files hashed, files to hash).
+
+    Sizes are checked first, files of the right size are then hashed on a
+    process pool using all cores. Hard-linked copies are hashed only once.
+    """
+    to_hash = {}  # {(device, inode): [entries]}
+    for entry in index.entries():
+        path = index.base_path / entry['path']
+        try:
+            stat = path.stat()
+        except OSError:
+            report.missing.append(entry)
+            continue
+        if stat.st_size < entry['size']:
+            report.truncated.append(entry)
+        elif stat.st_size != entry['size']:
+            report.corrupted.append(entry)
+        elif entry['hash'] and entry.get('hasher') in HASHERS:
+            to_hash.setdefault((stat.st_dev, stat.st_ino), []).append(entry)
+        else:
+            report.unchecked.append(entry)
+
+    total = len(to_hash)
+    yield 0, total
+    if not total:
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        for entries in to_hash.values():
+            entry = entries[0]
+            future = executor.submit(hash_file, index.base_path / entry['path'], entry['hasher'])
+            futures[future] = entries
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries = futures[future]
+                try:
+                    digest = future.result()
+                except OSError:
+                    report.missing.extend(entries)
+                    continue
+                for entry in entries:
+                    if digest == entry['hash'].lower():
+                        report.ok.append(entry)
+                    else:
+                        report.corrupted.append(entry)
+            yield total - len(pending), total
+    finally:
+        # Closed from the GUI thread on cancel: do not wait for the hashes
+        # still running, their processes exit once done
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(f"Usage: {sys.argv[0]} DOWNLOAD_DIRECTORY")
+    index = DownloadIndex(sys.argv[1])
+    if not index.exists():
+        sys.exit(f"No {DownloadIndex.FILE_NAME} in {sys.argv[1]}")
+
+    report = VerifyReport()
+    for done, total in verify_generator(index, report):
+        print(f"\rHashed {done}/{total} files", end="", flush=True)
+    print()
+    print(report.summary())
+    for entry in report.bad_entries():
+        print(f"  {entry['path']}")
+    sys.exit(1 if report.bad_entries() else 0)
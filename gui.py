@@ -5,17 +5,36 @@ Created on Thu May 15 15:06:43 2025
 @author: simon
 """
 
+import time
+_START_TIME = time.perf_counter()
+
 import sys
+import os
+import asyncio
+import importlib
+import threading
+import queue
+import gzip
+import json
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QAction, QDialog, QVBoxLayout, QLabel,
     QLineEdit, QPushButton, QMessageBox, QHBoxLayout, QFormLayout, QComboBox,
     QTreeWidget, QTreeWidgetItem, QSplitter, QWidget, QFileDialog,
-    QProgressBar
+    QProgressBar, QProgressDialog, QListWidget, QListWidgetItem, QSpinBox, QMenu
 )
 from PyQt5.QtGui import QPixmap, QBrush, QColor, QIcon
-from PyQt5.QtCore import Qt, pyqtSignal, QTimer
-
-import omero_connection
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QObject, QSize
+
+# omero_connection is not imported here: omero.gateway pulls in the whole Ice
+# runtime, it is imported in the background once the window is shown (see
+# MainWindow._preload_omero) and locally where it is needed.
+from hierarchy_model import HierarchyModel, ROOT, PROJECT, DATASET, FOLDER, IMAGE
+from download_index import DownloadIndex, VerifyReport, verify_generator
+from profiling import PROFILER
+from bandwidth import MB, TokenBucket, BandwidthSchedule, BandwidthLimiter, format_rate
 from pathlib import Path
 
 OMERO_TOKEN_URL = "https://omero-cci-users.gu.se/oauth/sessiontoken"
@@ -25,13 +44,64 @@ APP_VERSION = "1.0.0"
 DEFAULT_HOST = "omero-cci-cli.gu.se"
 DEFAULT_PORT = "4064"
 
+# Ice compression modes of omero_connection (COMPRESS_*), spelled out here
+# so the settings do not wait for the OMERO import
+COMPRESSION_CHOICES = [
+    ("Off", "off"),
+    ("Metadata only", "metadata"),
+    ("Metadata and transfers", "all"),
+]
+
+# Set to print the startup timing report, also shown in Help > Startup Timing
+STARTUP_TIMING_ENV = "OMERO_CLIENT_STARTUP_TIMING"
+STARTUP_TIMES = []  # [(step, seconds since the start of gui.py)]
+
+
+def mark_startup(step):
+    STARTUP_TIMES.append((step, time.perf_counter() - _START_TIME))
+
+
+def startup_report():
+    lines = ["Startup timing (seconds since gui.py started):"]
+    lines += [f"  {seconds:7.3f}  {step}" for step, seconds in STARTUP_TIMES]
+    return "\n".join(lines)
+
+
+mark_startup("Qt and standard library imported")
+
+# Item data role holding the node index in the HierarchyModel of the tree
+NODE_ROLE = 1
+
+# Bumped whenever the layout of saved download queues changes
+QUEUE_FILE_VERSION = 1
+
+# Yielded by the tree loader while waiting on the server, it is then polled
+# every TREE_LOADER_POLL_MS instead of on every pass of the event loop
+TREE_LOADER_WAIT = "wait"
+TREE_LOADER_POLL_MS = 20
+
+# Suffix for files still being transferred, renamed once complete
+PARTIAL_SUFFIX = ".part"
+
+# Bytes read per call to the file store when the bandwidth is not limited
+TRANSFER_CHUNK_SIZE = 2621440
+
+# Longest side of the thumbnails fetched from OMERO, and their disk cache
+THUMBNAIL_SIZE = 128
+THUMBNAIL_CACHE_DIR = Path.home() / ".cache" / "omero_download_client" / "thumbnails"
+
 class SettingsDialog(QDialog):
-    def __init__(self, parent=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    def __init__(self, parent=None, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 client_limit=0, job_limit=0, schedule="", compression=None):
         super().__init__(parent)
         self.setWindowTitle("Settings")
-        self.setFixedSize(300, 150)
+        self.setFixedSize(420, 290)
         self.host = host
         self.port = port
+        self.compression = dict(compression or {})  # {host: mode}
+        self.client_limit = client_limit  # MB/s, 0 is unlimited
+        self.job_limit = job_limit
+        self.schedule = schedule
 
         layout = QFormLayout()
 
@@ -43,6 +113,38 @@ class SettingsDialog(QDialog):
         self.port_input.setText(str(self.port))
         layout.addRow("Port:", self.port_input)
 
+        self.compression_combo = QComboBox(self)
+        for label, mode in COMPRESSION_CHOICES:
+            self.compression_combo.addItem(label, mode)
+        self.compression_combo.setToolTip(
+            "Compress the traffic with this server, faster over a slow connection\n"
+            "but slower on a fast network. Used from the next login.")
+        self.compression_combo.setCurrentIndex(
+            max(0, self.compression_combo.findData(self.compression.get(self.host, "off"))))
+        layout.addRow("Compression:", self.compression_combo)
+
+        self.client_limit_input = QSpinBox(self)
+        self.client_limit_input.setRange(0, 10000)
+        self.client_limit_input.setSuffix(" MB/s")
+        self.client_limit_input.setSpecialValueText("Unlimited")
+        self.client_limit_input.setValue(self.client_limit)
+        layout.addRow("Client bandwidth:", self.client_limit_input)
+
+        self.job_limit_input = QSpinBox(self)
+        self.job_limit_input.setRange(0, 10000)
+        self.job_limit_input.setSuffix(" MB/s")
+        self.job_limit_input.setSpecialValueText("Unlimited")
+        self.job_limit_input.setValue(self.job_limit)
+        layout.addRow("Per download:", self.job_limit_input)
+
+        self.schedule_input = QLineEdit(self)
+        self.schedule_input.setPlaceholderText("e.g. 08:00-18:00=5, 18:00-08:00=0")
+        self.schedule_input.setToolTip(
+            "Client bandwidth by time of day in MB/s, 0 is unlimited.\n"
+            "Outside these windows the client bandwidth above applies.")
+        self.schedule_input.setText(self.schedule)
+        layout.addRow("Schedule:", self.schedule_input)
+
         btn_layout = QHBoxLayout()
         ok_btn = QPushButton("OK")
         ok_btn.clicked.connect(self.accept)
@@ -60,6 +162,16 @@ class SettingsDialog(QDialog):
         if not self.host or not self.port:
             QMessageBox.warning(self, "Invalid Input", "Please enter both hostname and port.")
             return
+        schedule = self.schedule_input.text().strip()
+        try:
+            BandwidthSchedule.parse(schedule)
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Input", str(e))
+            return
+        self.client_limit = self.client_limit_input.value()
+        self.job_limit = self.job_limit_input.value()
+        self.schedule = schedule
+        self.compression[self.host] = self.compression_combo.currentData()
         super().accept()
 
 
@@ -102,181 +214,730 @@ class LoginDialog(QDialog):
         super().accept()
 
 
-class OmeroExplorerTree(QTreeWidget):
+class ZarrExportDialog(QDialog):
+    """Choose the channels, Z/T ranges and resolution level to export"""
+
+    def __init__(self, pixels_info, output_path, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Export {pixels_info['name']} as OME-Zarr")
+        self.info = pixels_info
+
+        layout = QFormLayout()
+
+        self.channel_list = QListWidget()
+        for label in pixels_info['channels']:
+            item = QListWidgetItem(label)
+            item.setCheckState(Qt.Checked)
+            self.channel_list.addItem(item)
+        layout.addRow("Channels:", self.channel_list)
+
+        self.z_start, self.z_stop = self._range_row(layout, "Z:", pixels_info['size_z'])
+        self.t_start, self.t_stop = self._range_row(layout, "T:", pixels_info['size_t'])
+
+        self.level_combo = QComboBox()
+        for size_x, size_y in pixels_info['levels']:
+            self.level_combo.addItem(f"{size_x} x {size_y}")
+        layout.addRow("Resolution:", self.level_combo)
+
+        path_layout = QHBoxLayout()
+        self.path_input = QLineEdit(output_path)
+        browse_btn = QPushButton("Browse...")
+        browse_btn.clicked.connect(self._browse)
+        path_layout.addWidget(self.path_input)
+        path_layout.addWidget(browse_btn)
+        layout.addRow("Save to:", path_layout)
+
+        btn_layout = QHBoxLayout()
+        ok_btn = QPushButton("Export")
+        ok_btn.clicked.connect(self.accept)
+        cancel_btn = QPushButton("Cancel")
+        cancel_btn.clicked.connect(self.reject)
+        btn_layout.addWidget(ok_btn)
+        btn_layout.addWidget(cancel_btn)
+        layout.addRow(btn_layout)
+
+        self.setLayout(layout)
+
+    def _range_row(self, layout, label, size):
+        start = QSpinBox()
+        start.setRange(1, size)
+        start.setValue(1)
+        stop = QSpinBox()
+        stop.setRange(1, size)
+        stop.setValue(size)
+        row = QHBoxLayout()
+        row.addWidget(start)
+        row.addWidget(QLabel("to"))
+        row.addWidget(stop)
+        layout.addRow(label, row)
+        return start, stop
+
+    def _browse(self):
+        directory = QFileDialog.getExistingDirectory(self, "Select Export Directory")
+        if directory:
+            self.path_input.setText(str(Path(directory) / Path(self.path_input.text()).name))
+
+    def accept(self):
+        self.channels = [i for i in range(self.channel_list.count())
+                         if self.channel_list.item(i).checkState() == Qt.Checked]
+        # Shown 1-based and inclusive, stored as [start, stop)
+        self.z_range = (self.z_start.value() - 1, self.z_stop.value())
+        self.t_range = (self.t_start.value() - 1, self.t_stop.value())
+        self.level = self.level_combo.currentIndex()
+        self.output_path = self.path_input.text().strip()
+        if not self.channels:
+            QMessageBox.warning(self, "Invalid Input", "Please select at least one channel.")
+            return
+        if self.z_range[0] >= self.z_range[1] or self.t_range[0] >= self.t_range[1]:
+            QMessageBox.warning(self, "Invalid Input", "Please enter valid Z and T ranges.")
+            return
+        if not self.output_path:
+            QMessageBox.warning(self, "Invalid Input", "Please select where to save the export.")
+            return
+        # The export fills the directory and removes it if cancelled, never
+        # point it at existing data
+        path = Path(self.output_path)
+        if path.exists() and (not path.is_dir() or any(path.iterdir())):
+            QMessageBox.warning(self, "Invalid Input",
+                                f"{path} already exists and is not empty, please choose a new name.")
+            return
+        super().accept()
+
+
+class HierarchyTree(QTreeWidget):
+    """QTreeWidget whose items mirror the nodes of a HierarchyModel.
+
+    Items only hold their node index under NODE_ROLE, everything else is
+    read from the model.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.model = HierarchyModel()
+        self.items = []  # QTreeWidgetItem of each node, None once removed
+
+    def clear(self):
+        super().clear()
+        self.model.clear()
+        self.items = []
+
+    def node_of(self, item):
+        return item.data(0, NODE_ROLE)
+
+    def _new_item(self, node):
+        item = QTreeWidgetItem()
+        item.setText(0, self.model.names[node])
+        item.setData(0, NODE_ROLE, node)
+        self.items.append(item)
+        return item
+
+    def add_node(self, kind, node_id, name, parent=ROOT, group_id=None):
+        node = self.model.add(kind, node_id, name, parent, group_id)
+        item = self._new_item(node)
+        if parent == ROOT:
+            self.addTopLevelItem(item)
+        else:
+            self.items[parent].addChild(item)
+        return node
+
+    def add_project(self, project_id, name, datasets, group_id=None):
+        """Adds a whole project at once, datasets is [(dataset_id, name,
+        {image_id: name})]. Each dataset gets its images in one addChildren.
+        """
+        model = self.model
+        self.setUpdatesEnabled(False)
+        try:
+            project = model.add(PROJECT, project_id, name, ROOT, group_id)
+            project_item = self._new_item(project)
+            dataset_items = []
+            for dataset_id, dataset_name, images in datasets:
+                dataset = model.add(DATASET, dataset_id, dataset_name, project)
+                dataset_item = self._new_item(dataset)
+                dataset_item.addChildren([
+                    self._new_item(model.add(IMAGE, image_id, image_name, dataset))
+                    for image_id, image_name in images.items()])
+                dataset_items.append(dataset_item)
+            project_item.addChildren(dataset_items)
+            self.addTopLevelItem(project_item)
+        finally:
+            self.setUpdatesEnabled(True)
+        return project
+
+    def remove_node(self, node):
+        """Removes the node, its subtree and their items"""
+        item = self.items[node]
+        for removed in self.model.iter_subtree(node):
+            self.items[removed] = None
+        self.model.remove(node)
+        parent = item.parent()
+        if parent is None:
+            self.takeTopLevelItem(self.indexOfTopLevelItem(item))
+        else:
+            parent.removeChild(item)
+
+    def rename_node(self, node, name):
+        self.model.names[node] = name
+        self.items[node].setText(0, name)
+
+
+class ThumbnailCache(QObject):
+    """Image thumbnails, fetched in batches on a background thread.
+
+    Kept as JPEG bytes in an in-memory LRU, backed by a size limited disk
+    cache per server, so that showing them never waits on the network.
+    """
+    thumbnailsReady = pyqtSignal(list)  # image ids fetched, get() is None for those without
+    _fetched = pyqtSignal(list, dict)   # requested ids, {image_id: bytes}, from the worker thread
+    BATCH_SIZE = 50
+    MEMORY_LIMIT = 32 * 1024 * 1024
+    DISK_LIMIT = 512 * 1024 * 1024
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.conn = None
+        self.cache_dir = None
+        self._memory = OrderedDict()  # {image_id: bytes}, least recently used first
+        self._memory_bytes = 0
+        self._requested = set()
+        self._disk_bytes = {}  # {cache_dir: bytes}, only touched by the worker thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._fetched.connect(self._store)
+
+    def set_connection(self, conn):
+        self.conn = conn
+        self._memory.clear()
+        self._memory_bytes = 0
+        self._requested.clear()
+        if conn is not None:
+            self.cache_dir = THUMBNAIL_CACHE_DIR / conn.hostname
+
+    def get(self, image_id):
+        data = self._memory.get(image_id)
+        if data is not None:
+            self._memory.move_to_end(image_id)
+        return data
+
+    def request(self, image_ids):
+        missing = [i for i in image_ids if i not in self._memory and i not in self._requested]
+        if not missing or self.conn is None:
+            return
+        self._requested.update(missing)
+        for start in range(0, len(missing), self.BATCH_SIZE):
+            self._executor.submit(self._fetch_batch, self.conn, self.cache_dir,
+                                  missing[start:start + self.BATCH_SIZE])
+
+    def _fetch_batch(self, conn, cache_dir, image_ids):
+        # Worker thread: no Qt objects here, results go back through a signal
+        thumbnails = {}
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            misses = []
+            for image_id in image_ids:
+                path = cache_dir / f"{image_id}.jpg"
+                try:
+                    thumbnails[image_id] = path.read_bytes()
+                    os.utime(path)  # the disk cache is trimmed by age of last use
+                except OSError:
+                    misses.append(image_id)
+            if misses:
+                fetched = conn.get_thumbnail_set(misses, THUMBNAIL_SIZE)
+                for image_id, data in fetched.items():
+                    (cache_dir / f"{image_id}.jpg").write_bytes(data)
+                thumbnails.update(fetched)
+                self._trim_disk_cache(cache_dir, sum(len(d) for d in fetched.values()))
+        except Exception as e:
+            print(f"Failed to fetch {len(image_ids)} thumbnails: {e}")
+        self._fetched.emit(image_ids, thumbnails)
+
+    def _trim_disk_cache(self, cache_dir, added_bytes):
+        # One count per server directory, switching server does not mix them
+        if cache_dir not in self._disk_bytes:
+            self._disk_bytes[cache_dir] = sum(p.stat().st_size for p in cache_dir.glob("*.jpg"))
+        else:
+            self._disk_bytes[cache_dir] += added_bytes
+        if self._disk_bytes[cache_dir] <= self.DISK_LIMIT:
+            return
+        for path in sorted(cache_dir.glob("*.jpg"), key=lambda p: p.stat().st_mtime):
+            if self._disk_bytes[cache_dir] <= self.DISK_LIMIT * 0.8:
+                break
+            size = path.stat().st_size
+            path.unlink()
+            self._disk_bytes[cache_dir] -= size
+
+    def _store(self, image_ids, thumbnails):
+        # Failed ids are no longer requested, a later request tries them again
+        self._requested.difference_update(image_ids)
+        for image_id, data in thumbnails.items():
+            self._memory[image_id] = data
+            self._memory_bytes += len(data)
+        while self._memory_bytes > self.MEMORY_LIMIT:
+            _, data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(data)
+        self.thumbnailsReady.emit(list(image_ids))
+
+
+class OmeroExplorerTree(HierarchyTree):
     itemDoubleClickedToTransfer = pyqtSignal(QTreeWidgetItem)  # Custom signal
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setColumnCount(1)
         self.setHeaderLabels(['OMERO Data'])
+        self.setIconSize(QSize(32, 32))
+        self.setMouseTracking(True)  # itemEntered for the preview
         self.itemDoubleClicked.connect(self._emit_double_clicked_item)
 
+        self.thumbnails = ThumbnailCache(self)
+        self.thumbnails.thumbnailsReady.connect(self._on_thumbnails_ready)
+        self._waiting = {}  # {image_id: {image nodes shown without thumbnail}}
+        # Scrolling fires many events, only look at what is visible once it settles
+        self._visible_timer = QTimer(self)
+        self._visible_timer.setSingleShot(True)
+        self._visible_timer.setInterval(100)
+        self._visible_timer.timeout.connect(self.request_visible_thumbnails)
+        self.verticalScrollBar().valueChanged.connect(self._visible_timer.start)
+        self.itemExpanded.connect(self._visible_timer.start)
+
+    def clear(self):
+        super().clear()
+        self._waiting.clear()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._visible_timer.start()
+
     def _emit_double_clicked_item(self, item):
         self.itemDoubleClickedToTransfer.emit(item)
 
+    def request_visible_thumbnails(self):
+        model = self.model
+        image_ids = []
+        bottom = self.viewport().height()
+        item = self.itemAt(0, 0)
+        while item is not None and self.visualItemRect(item).top() < bottom:
+            node = self.node_of(item)
+            if model.kinds[node] == IMAGE and item.icon(0).isNull():
+                image_id = model.ids[node]
+                data = self.thumbnails.get(image_id)
+                if data is not None:
+                    self._set_thumbnail_icon(item, data)
+                else:
+                    self._waiting.setdefault(image_id, set()).add(node)
+                    image_ids.append(image_id)
+            item = self.itemBelow(item)
+        self.thumbnails.request(image_ids)
+
+    def _on_thumbnails_ready(self, image_ids):
+        for image_id in image_ids:
+            data = self.thumbnails.get(image_id)
+            nodes = self._waiting.pop(image_id, ())
+            if data is None:
+                continue
+            for node in nodes:
+                if self.items[node] is not None:  # not removed by a refresh meanwhile
+                    self._set_thumbnail_icon(self.items[node], data)
+
+    def _set_thumbnail_icon(self, item, data):
+        pixmap = QPixmap()
+        if pixmap.loadFromData(data):
+            item.setIcon(0, QIcon(pixmap.scaled(self.iconSize(), Qt.KeepAspectRatio,
+                                                Qt.SmoothTransformation)))
+
+
+def format_size(num_bytes):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if num_bytes < 1024 or unit == "TB":
+            break
+        num_bytes /= 1024
+    return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+
+
+class QueueSizeEstimator(QObject):
+    """Keeps the byte and file count of the download queue up to date.
+
+    Images are looked up in batches, one server call per batch on a
+    background thread. Filesets shared by several images are only counted
+    once.
+    """
+    totalsChanged = pyqtSignal()
+    _fetched = pyqtSignal(list, dict)  # batch, {image_id: (fileset_id, bytes, files)}
+    BATCH_SIZE = 500
+
+    def __init__(self, queue_tree):
+        super().__init__(queue_tree)
+        self.queue_tree = queue_tree
+        self.total_bytes = 0
+        self.total_files = 0
+        self._image_filesets = {}  # {image_id: fileset_id}, None while pending
+        self._filesets = {}        # {fileset_id: [bytes, files, queued images]}
+        self._pending = {}         # {group_id: {image_id: None}}, in queueing order
+        self._fetching = False     # one batch at a time on the worker
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._fetched.connect(self._apply)
+
+    def is_pending(self):
+        return bool(self._pending) or self._fetching
+
+    def add_images(self, group_id, image_ids):
+        new_ids = [i for i in image_ids if i not in self._image_filesets]
+        if not new_ids:
+            return
+        if group_id is None:
+            import omero_connection
+            group_id = omero_connection.ALL_GROUPS
+        pending = self._pending.setdefault(group_id, {})
+        for image_id in new_ids:
+            self._image_filesets[image_id] = None
+            pending[image_id] = None
+        self._fetch_next()
+        self.totalsChanged.emit()
+
+    def remove_images(self, image_ids):
+        for image_id in image_ids:
+            fileset_id = self._image_filesets.pop(image_id, None)
+            if fileset_id is None:
+                continue  # unknown, or still pending and ignored when fetched
+            entry = self._filesets[fileset_id]
+            entry[2] -= 1
+            if entry[2] == 0:
+                self.total_bytes -= entry[0]
+                self.total_files -= entry[1]
+                del self._filesets[fileset_id]
+        self.totalsChanged.emit()
+
+    def get_fileset_info(self, image_id):
+        """Returns (fileset_id, bytes, files) if already known, else None"""
+        fileset_id = self._image_filesets.get(image_id)
+        if fileset_id is None:
+            return None
+        total_bytes, file_count, _ = self._filesets[fileset_id]
+        return fileset_id, total_bytes, file_count
+
+    def restore(self, group_id, image_filesets, fileset_sizes):
+        """Adds images whose fileset and size are already known, e.g. from a
+        saved queue. Images with no known fileset are looked up as usual.
+        """
+        unknown_ids = []
+        for image_id, fileset_id in image_filesets.items():
+            if image_id in self._image_filesets:
+                continue
+            if fileset_id is None or fileset_id not in fileset_sizes:
+                unknown_ids.append(image_id)
+                continue
+            self._image_filesets[image_id] = fileset_id
+            if fileset_id in self._filesets:
+                self._filesets[fileset_id][2] += 1
+            else:
+                total_bytes, file_count = fileset_sizes[fileset_id]
+                self._filesets[fileset_id] = [total_bytes, file_count, 1]
+                self.total_bytes += total_bytes
+                self.total_files += file_count
+        self.add_images(group_id, unknown_ids)
+        self.totalsChanged.emit()
+
+    def clear(self):
+        self.total_bytes = 0
+        self.total_files = 0
+        self._image_filesets.clear()
+        self._filesets.clear()
+        self._pending.clear()
+        self.totalsChanged.emit()
+
+    def resume(self):
+        """Fetches the sizes left pending, e.g. of a queue loaded before login"""
+        self._fetch_next()
+        self.totalsChanged.emit()
+
+    def _fetch_next(self):
+        if self._fetching:
+            return  # _apply fetches the next batch
+        conn = self.queue_tree.conn
+        if not self._pending or conn is None:
+            return  # kept while logged out, resume() fetches them
+
+        group_id, pending = next(iter(self._pending.items()))
+        batch = []
+        while pending and len(batch) < self.BATCH_SIZE:
+            image_id = next(iter(pending))
+            del pending[image_id]
+            if self._image_filesets.get(image_id, 0) is None:  # still queued and unknown
+                batch.append(image_id)
+        if not pending:
+            del self._pending[group_id]
+        if not batch:
+            self._fetch_next()
+            return
+        self._fetching = True
+        self._executor.submit(self._fetch_batch, conn, group_id, batch)
 
-class DownloadQueueTree(QTreeWidget):
+    def _fetch_batch(self, conn, group_id, batch):
+        # Worker thread: no Qt objects here, results go back through a signal
+        try:
+            sizes = conn.get_fileset_sizes_from_imageIDs(batch, group_id)
+        except Exception as e:
+            print(f"Failed to fetch the size of {len(batch)} images: {e}")
+            sizes = {}
+        self._fetched.emit(batch, sizes)
+
+    def _apply(self, batch, sizes):
+        self._fetching = False
+        for image_id in batch:
+            if self._image_filesets.get(image_id, 0) is not None:
+                continue  # removed meanwhile, or already counted
+            if image_id not in sizes:
+                del self._image_filesets[image_id]  # no fileset to download
+                continue
+            fileset_id, total_bytes, file_count = sizes[image_id]
+            self._image_filesets[image_id] = fileset_id
+            if fileset_id in self._filesets:
+                self._filesets[fileset_id][2] += 1
+            else:
+                self._filesets[fileset_id] = [total_bytes, file_count, 1]
+                self.total_bytes += total_bytes
+                self.total_files += file_count
+        self._fetch_next()
+        self.totalsChanged.emit()
+
+
+class DownloadQueueTree(HierarchyTree):
     itemDoubleClickedToTransfer = pyqtSignal(QTreeWidgetItem)  # Custom signal
     
     def __init__(self, parent=None, conn=None):
         super().__init__(parent)
         self.conn = conn
+        self.source_model = None  # HierarchyModel of the OMERO tree
         self.setColumnCount(1)
         self.setHeaderLabels(['Download Queue'])
-        self._existing_projects = {}  # {project_id: QTreeWidgetItem}
+        self.size_estimator = QueueSizeEstimator(self)
         self.itemDoubleClicked.connect(self.remove_from_download_tree)
 
+    def clear(self):
+        super().clear()
+        self.size_estimator.clear()
+
+    def set_connection(self, conn):
+        self.conn = conn
+        self.size_estimator.resume()
+
     def remove_from_download_tree(self, item, column):
-        parent = item.parent()
-        node_type, node_id = item.data(0, 1)
-        if parent is None:
-            self.takeTopLevelItem(self.indexOfTopLevelItem(item))
-            if node_type == 'project' and node_id in self._existing_projects:
-                del self._existing_projects[node_id]
-        else:
-            parent.removeChild(item)
+        model = self.model
+        node = self.node_of(item)
+        image_ids = [model.ids[image] for image in model.iter_images(node)]
+        self.remove_node(node)
+        # The same image can still be queued in another dataset
+        self.size_estimator.remove_images(
+            [image_id for image_id in image_ids if not model.contains(IMAGE, image_id)])
         
         self.itemDoubleClickedToTransfer.emit(item)
 
+    def rename_objects(self, names):
+        """Follows renames made in OMERO, names is {(kind, id): new name}"""
+        model = self.model
+        for node, item in enumerate(self.items):
+            if item is None or model.kinds[node] == FOLDER:
+                continue
+            name = names.get((model.kinds[node], model.ids[node]))
+            if name is not None:
+                self.rename_node(node, name)
+
+    @PROFILER.profile_phase("add_omerohierarchy")
     def add_omerohierarchy(self, omero_item):
-        hierarchy = self._get_full_hierarchy(omero_item)
-        for project_id, project_data in hierarchy.items():
-            if project_id in self._existing_projects:
-                project_node = self._existing_projects[project_id]
-            else:
-                project_node = QTreeWidgetItem(self)
-                project_node.setText(0, project_data['name'])
-                project_node.setData(0, 1, ('project', project_id))
-                self._existing_projects[project_id] = project_node
-
-            for dataset_id, dataset_data in project_data['datasets'].items():
-                dataset_node = self._find_or_add_child(project_node, 'dataset', dataset_id, dataset_data['name'])
-                for image_id, image_name in dataset_data['images'].items():
-                    folder_name = self.conn.get_original_upload_folder(image_id)
-                    if folder_name and folder_name.lower() != 'uploads':
-                        folder_node = self._find_or_add_child(dataset_node, 'folder', folder_name, folder_name)
-                        self._find_or_add_child(folder_node, 'image', image_id, image_name)
+        src = self.source_model
+        node = omero_item.data(0, NODE_ROLE)
+        kind = src.kinds[node]
+        project = src.ancestor(node, PROJECT)
+        if project is None:
+            return
+        if kind == PROJECT:
+            datasets = src.child_nodes(project)
+        else:
+            datasets = [src.ancestor(node, DATASET)]
+
+        dataset_images = [(dataset, [node] if kind == IMAGE else src.child_nodes(dataset))
+                          for dataset in datasets]
+        try:
+            folders = asyncio.run(self._get_upload_folders(
+                [src.ids[image] for _, images in dataset_images for image in images]))
+        except Exception as e:
+            # Nothing queued rather than images in the wrong folder
+            QMessageBox.critical(self, "Error", f"Failed to read the upload folders: {str(e)}")
+            return
+
+        group_id = src.groups.get(project)
+        project_node = self._find_or_add_child(
+            ROOT, PROJECT, src.ids[project], src.names[project], group_id)
+        for dataset, images in dataset_images:
+            dataset_node = self._find_or_add_child(
+                project_node, DATASET, src.ids[dataset], src.names[dataset])
+            image_ids = []
+            for image in images:
+                image_id = src.ids[image]
+                image_ids.append(image_id)
+                folder_name = folders[image_id]
+                parent_node = dataset_node
+                if folder_name and folder_name.lower() != 'uploads':
+                    parent_node = self._find_or_add_child(dataset_node, FOLDER, folder_name, folder_name)
+                self._find_or_add_child(parent_node, IMAGE, image_id, src.names[image])
+
+            self.size_estimator.add_images(group_id, image_ids)
+
+    async def _get_upload_folders(self, image_ids):
+        """{image_id: folder}, the annotations are read concurrently"""
+        aio = self.conn.aio
+        folders = await asyncio.gather(
+            *(aio.get_original_upload_folder(image_id) for image_id in image_ids))
+        return dict(zip(image_ids, folders))
+
+    def save_queue(self, path):
+        """Writes the queue as gzipped JSON, one nested list per project:
+        [project_id, name, group_id, [[dataset_id, name, [[image_id, name,
+        folder, fileset_id], ...]], ...]], plus {fileset_id: [bytes, files]}.
+        """
+        model = self.model
+        projects = []
+        filesets = {}
+        for project in model.child_nodes():
+            datasets = []
+            for dataset in model.child_nodes(project):
+                images = []
+                for child in model.child_nodes(dataset):
+                    if model.kinds[child] == FOLDER:
+                        folder = model.names[child]
+                        image_nodes = model.child_nodes(child)
                     else:
-                        self._find_or_add_child(dataset_node, 'image', image_id, image_name)
-
-    def _find_or_add_child(self, parent, node_type, node_id, node_name):
-        # node_id can be str for folder, int for others
-        for i in range(parent.childCount()):
-            child = parent.child(i)
-            data = child.data(0, 1)
-            if data and data[0] == node_type and data[1] == node_id:
-                return child
-        child = QTreeWidgetItem(parent)
-        child.setText(0, node_name)
-        child.setData(0, 1, (node_type, node_id))
-        return child
-
-    def _get_full_hierarchy(self, item):
-        """Returns hierarchical data for the clicked item and its parents"""
-        hierarchy = {}
-        current_item = item
-
-        # Traverse up to project level
-        while current_item:
-            node_type, node_id = current_item.data(0, 1)
-            
-            if node_type == 'project':
-                hierarchy[node_id] = {
-                    'name': current_item.text(0),
-                    'datasets': self._get_child_datasets(current_item)
-                }
-                break
-            elif node_type == 'dataset':
-                parent_project = self._find_parent_project(current_item)
-                if parent_project:
-                    project_id = parent_project.data(0, 1)[1]
-                    hierarchy[project_id] = {
-                        'name': parent_project.text(0),
-                        'datasets': {
-                            node_id: {
-                                'name': current_item.text(0),
-                                'images': self._get_child_images(current_item)
-                            }
-                        }
-                    }
-                break
-            elif node_type == 'image':
-                parent_dataset = self._find_parent_dataset(current_item)
-                parent_project = self._find_parent_project(parent_dataset)
-                if parent_dataset and parent_project:
-                    project_id = parent_project.data(0, 1)[1]
-                    dataset_id = parent_dataset.data(0, 1)[1]
-                    hierarchy[project_id] = {
-                        'name': parent_project.text(0),
-                        'datasets': {
-                            dataset_id: {
-                                'name': parent_dataset.text(0),
-                                'images': {
-                                    node_id: current_item.text(0)
-                                }
-                            }
-                        }
-                    }
-                break
-            current_item = current_item.parent()
-        return hierarchy
-
-    def _add_dataset(self, project_node, dataset_id, dataset_data):
-        """Add dataset to project node if not already present"""
-        for i in range(project_node.childCount()):
-            existing_dataset = project_node.child(i)
-            if existing_dataset.data(0, 1)[1] == dataset_id:
-                return  # Dataset already exists
-
-        dataset_node = QTreeWidgetItem(project_node)
-        dataset_node.setText(0, dataset_data['name'])
-        dataset_node.setData(0, 1, ('dataset', dataset_id))
-
-        for image_id, image_name in dataset_data['images'].items():
-            image_node = QTreeWidgetItem(dataset_node)
-            image_node.setText(0, image_name)
-            image_node.setData(0, 1, ('image', image_id))
-
-    # Helper functions 
-    def _find_parent_project(self, item):
-        while item:
-            data = item.data(0, 1)
-            if data is not None and data[0] == 'project':
-                return item
-            item = item.parent()
-        return None
-    
-    def _find_parent_dataset(self, item):
-        while item:
-            data = item.data(0, 1)
-            if data is not None and data[0] == 'dataset':
-                return item
-            item = item.parent()
-        return None
-
-    def _get_child_datasets(self, project_item):
-        datasets = {}
-        for i in range(project_item.childCount()):
-            dataset_item = project_item.child(i)
-            dataset_id = dataset_item.data(0, 1)[1]
-            datasets[dataset_id] = {
-                'name': dataset_item.text(0),
-                'images': self._get_child_images(dataset_item)
-            }
-        return datasets
-
-    def _get_child_images(self, dataset_item):
-        images = {}
-        for i in range(dataset_item.childCount()):
-            image_item = dataset_item.child(i)
-            image_id = image_item.data(0, 1)[1]
-            images[image_id] = image_item.text(0)
-        return images
+                        folder = None
+                        image_nodes = [child]
+                    for image in image_nodes:
+                        image_id = model.ids[image]
+                        fileset_info = self.size_estimator.get_fileset_info(image_id)
+                        fileset_id = None
+                        if fileset_info is not None:
+                            fileset_id, total_bytes, file_count = fileset_info
+                            filesets[fileset_id] = [total_bytes, file_count]
+                        images.append([image_id, model.names[image], folder, fileset_id])
+                datasets.append([model.ids[dataset], model.names[dataset], images])
+            projects.append([model.ids[project], model.names[project],
+                             model.groups.get(project), datasets])
+
+        queue = {'version': QUEUE_FILE_VERSION, 'projects': projects, 'filesets': filesets}
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(queue, f, separators=(',', ':'))
+
+    def load_queue(self, path):
+        """Replaces the queue with a saved one, without any server call"""
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            queue = json.load(f)
+        if queue.get('version') != QUEUE_FILE_VERSION:
+            raise ValueError(f"Unsupported queue file version: {queue.get('version')}")
+        # JSON object keys are always strings
+        fileset_sizes = {int(k): v for k, v in queue['filesets'].items()}
+
+        model = self.model
+        self.setUpdatesEnabled(False)
+        try:
+            self.clear()
+            project_items = []
+            for project_id, project_name, group_id, datasets in queue['projects']:
+                project = model.add(PROJECT, project_id, project_name, ROOT, group_id)
+                project_item = self._new_item(project)
+                image_filesets = {}
+                dataset_items = []
+                for dataset_id, dataset_name, images in datasets:
+                    dataset = model.add(DATASET, dataset_id, dataset_name, project)
+                    dataset_item = self._new_item(dataset)
+                    children = []
+                    folders = {}  # {folder name: (node, item)}
+                    for image_id, image_name, folder, fileset_id in images:
+                        image_filesets[image_id] = fileset_id
+                        if folder is None:
+                            image = model.add(IMAGE, image_id, image_name, dataset)
+                            children.append(self._new_item(image))
+                            continue
+                        if folder not in folders:
+                            folder_node = model.add(FOLDER, folder, folder, dataset)
+                            folders[folder] = (folder_node, self._new_item(folder_node))
+                            children.append(folders[folder][1])
+                        folder_node, folder_item = folders[folder]
+                        image = model.add(IMAGE, image_id, image_name, folder_node)
+                        folder_item.addChild(self._new_item(image))
+                    dataset_item.addChildren(children)
+                    dataset_items.append(dataset_item)
+                project_item.addChildren(dataset_items)
+                project_items.append(project_item)
+                self.size_estimator.restore(group_id, image_filesets, fileset_sizes)
+            self.addTopLevelItems(project_items)
+        finally:
+            self.setUpdatesEnabled(True)
+
+    def _find_or_add_child(self, parent, kind, node_id, name, group_id=None):
+        # node_id is the name for a folder, the OMERO id for the others
+        node = self.model.find_child(parent, kind, node_id)
+        if node is None:
+            node = self.add_node(kind, node_id, name, parent, group_id)
+        return node
+
+
+
+
+class TreeFetcher:
+    """Fetches the project/dataset/image hierarchy on a worker thread.
+
+    Every project is put in results as (project_id, name, [(dataset_id,
+    name, {image_id: name})]) as soon as it is complete, None marks the end.
+    The worker waits between two projects while paused and stops when
+    cancelled.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = queue.Queue()
+        self.error = None
+        self._cancelled = False
+        self._running = threading.Event()  # cleared while paused
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def set_paused(self, paused):
+        if paused:
+            self._running.clear()
+        else:
+            self._running.set()
+
+    def cancel(self):
+        self._cancelled = True
+        self._running.set()
 
+    def _run(self):
+        try:
+            # The server time, the GUI side only polls and inserts
+            with PROFILER.timed("tree_fetch_projects (worker)"):
+                projects = self.conn.get_user_projects()  # {project_id: project_name}
+            for proj_id, proj_name in projects.items():
+                self._running.wait()
+                if self._cancelled:
+                    return
+                with PROFILER.timed("tree_fetch_contents (worker)"):
+                    datasets = asyncio.run(self._fetch_project(proj_id))
+                self.results.put((proj_id, proj_name, datasets))
+        except Exception as e:
+            self.error = e
+        finally:
+            self.results.put(None)
 
+    async def _fetch_project(self, proj_id):
+        aio = self.conn.aio
+        datasets = await aio.get_dataset_from_projectID(proj_id)
+        images = await asyncio.gather(*(aio.get_images_from_datasetID(ds_id) for ds_id in datasets))
+        return [(ds_id, ds_name, ds_images)
+                for (ds_id, ds_name), ds_images in zip(datasets.items(), images)]
 
 
 class MainWindow(QMainWindow):
+    omeroPreloaded = pyqtSignal(str)  # error message, empty on success
+
     def __init__(self):
         super().__init__()
         
@@ -332,11 +993,18 @@ class MainWindow(QMainWindow):
         self.host = DEFAULT_HOST
         self.port = DEFAULT_PORT
 
-        # Initialize a timer for connection checks
+        # Bandwidth limits in MB/s, 0 is unlimited. The client bucket is shared
+        # by every transfer, so they add up to the client limit at most
+        self.client_limit = 0
+        self.job_limit = 0
+        self.bandwidth_schedule = ""
+        self.client_bucket = TokenBucket()
+        self.server_compression = {}  # {host: omero_connection COMPRESS_* mode}
+
+        # Initialize a timer for connection checks, only running while connected
         self.connection_timer = QTimer()
         self.connection_timer.setInterval(5000)  # Check every 5 seconds (adjust as needed)
         self.connection_timer.timeout.connect(self.check_connection)
-        self.connection_timer.start()
 
         # Status icon
         self.status_icon = QLabel()
@@ -347,6 +1015,19 @@ class MainWindow(QMainWindow):
         self.spinner_label.setText("")
         self.statusBar().addPermanentWidget(self.spinner_label)
 
+        # Pause/cancel controls for the tree loader, only shown while loading
+        self.tree_loader = None
+        self.tree_fetcher = None
+        self.tree_loader_paused = False
+        self.pause_load_btn = QPushButton("Pause")
+        self.pause_load_btn.clicked.connect(self.toggle_pause_tree_loader)
+        self.pause_load_btn.hide()
+        self.statusBar().addPermanentWidget(self.pause_load_btn)
+        self.cancel_load_btn = QPushButton("Cancel")
+        self.cancel_load_btn.clicked.connect(self.cancel_tree_loader)
+        self.cancel_load_btn.hide()
+        self.statusBar().addPermanentWidget(self.cancel_load_btn)
+
         self._create_menu()
         
         # Add group/user toolbar
@@ -377,7 +1058,24 @@ class MainWindow(QMainWindow):
         splitter = QSplitter(Qt.Horizontal)
         self.omero_tree = OmeroExplorerTree()
         self.download_tree = DownloadQueueTree()
-        splitter.addWidget(self.omero_tree)
+        self.download_tree.source_model = self.omero_tree.model
+        self.omero_tree.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.omero_tree.customContextMenuRequested.connect(self._show_omero_tree_menu)
+        # OMERO tree with the thumbnail preview below it
+        omero_pane = QWidget()
+        omero_layout = QVBoxLayout(omero_pane)
+        omero_layout.setContentsMargins(0, 0, 0, 0)
+        omero_layout.addWidget(self.omero_tree)
+        self.preview_label = QLabel()
+        self.preview_label.setAlignment(Qt.AlignCenter)
+        self.preview_label.setFixedHeight(THUMBNAIL_SIZE + 10)
+        omero_layout.addWidget(self.preview_label)
+        self.preview_image_id = None
+        self.omero_tree.itemEntered.connect(self.show_preview)
+        self.omero_tree.currentItemChanged.connect(self.show_preview)
+        self.omero_tree.thumbnails.thumbnailsReady.connect(self._on_preview_ready)
+
+        splitter.addWidget(omero_pane)
         splitter.addWidget(self.download_tree)
         main_layout.addWidget(splitter)  # <-- expands vertically
         
@@ -398,6 +1096,9 @@ class MainWindow(QMainWindow):
         
         # Spacer between path and download button
         bottom_layout.addStretch()
+
+        self.queue_size_label = QLabel()
+        bottom_layout.addWidget(self.queue_size_label)
         
         # Right side: download button
         download_btn = QPushButton("Download")
@@ -412,37 +1113,337 @@ class MainWindow(QMainWindow):
         self.omero_tree.itemDoubleClickedToTransfer.connect(
             self.download_tree.add_omerohierarchy)
         self.omero_tree.itemDoubleClickedToTransfer.connect(
-            self.update_omero_tree_highlight)
+            lambda item: self.update_omero_tree_highlight())
         self.download_tree.itemDoubleClickedToTransfer.connect(
             lambda item: QTimer.singleShot(0, self.update_omero_tree_highlight))
+        self.download_tree.size_estimator.totalsChanged.connect(
+            self.update_queue_size_label)
+        self.update_queue_size_label()
+
+    def update_queue_size_label(self):
+        estimator = self.download_tree.size_estimator
+        if estimator.total_files == 0 and not estimator.is_pending():
+            self.queue_size_label.setText("")
+            return
+        approx = "≥ " if estimator.is_pending() else ""
+        self.queue_size_label.setText(
+            f"Queued: {approx}{format_size(estimator.total_bytes)} in {estimator.total_files} files")
         
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not hasattr(self, '_preload_thread'):
+            mark_startup("Window shown")
+            # Let the window paint first, then load OMERO while the user logs in
+            QTimer.singleShot(0, self._preload_omero)
+
+    def _preload_omero(self):
+        self.statusBar().showMessage("Loading OMERO libraries...")
+        self.omeroPreloaded.connect(self._on_omero_preloaded)
+        self._preload_thread = threading.Thread(target=self._import_omero, daemon=True)
+        self._preload_thread.start()
+
+    def _import_omero(self):
+        # Background thread, an import elsewhere just waits for this one to finish
+        try:
+            importlib.import_module("omero_connection")
+            mark_startup("OMERO and Ice imported (background)")
+            self.omeroPreloaded.emit("")
+        except Exception as e:
+            self.omeroPreloaded.emit(str(e))
+
+    def _on_omero_preloaded(self, error):
+        if error:
+            self.statusBar().showMessage(f"Failed to load OMERO: {error}")
+            return
+        self.statusBar().clearMessage()
+        if os.environ.get(STARTUP_TIMING_ENV):
+            print(startup_report())
+
     def download_files(self):
         download_path = self.get_download_path()
         if not download_path:
             QMessageBox.warning(self, "No Download Path", "Please select a download directory.")
             return
+        self.dm = DownloadManager(self.download_tree, self.conn, download_path,
+                                  self.new_bandwidth_limiter())
+        self._start_download(self.dm.download_files_generator(), clear_queue=True)
+
+    def _start_download(self, generator, clear_queue):
         self.progress_dialog = DownloadProgressDialog(self)
+        self.progress_dialog.pauseRequested.connect(self.pause_download)
+        self.progress_dialog.resumeRequested.connect(self.resume_download)
+        self.progress_dialog.cancelRequested.connect(self.cancel_download)
         self.progress_dialog.show()
-        
-        self.dm = DownloadManager(self.download_tree, self.conn, download_path)
         self.dm.progress_signals = self.progress_dialog  # Dialog handles set_* methods
     
-        self.generator = self.dm.download_files_generator()
+        self.generator = generator
+        self.clear_queue_when_done = clear_queue
         self.busy = True
         self.update_status_icon()
         self.step_download()
 
     def step_download(self):
+        if self.dm.paused:
+            return  # resume_download restarts the stepping
         try:
-            next(self.generator)
-            QTimer.singleShot(0, self.step_download)
+            delay = next(self.generator)
+            # Numbers are the seconds to wait for the bandwidth limit
+            delay = int(delay * 1000) if isinstance(delay, float) else 0
+            QTimer.singleShot(delay, self.step_download)
         except StopIteration:
-            self.progress_dialog.close()
-            self.download_tree.clear()
-            self.update_omero_tree_highlight()
+            self.progress_dialog.accept()  # close() would go through reject()
+            meter = self.dm.limiter.meter
+            self.statusBar().showMessage(
+                f"Transferred {format_size(meter.total)}, "
+                f"{format_rate(meter.average())} on average", 30000)
+            if self.clear_queue_when_done and not self.dm.cancelled:
+                # Keep the queue on cancel so the user can start again
+                self.download_tree.clear()
+                self.update_omero_tree_highlight()
             self.busy = False
             self.update_status_icon()
+        except Exception as e:
+            self.progress_dialog.accept()
+            self.busy = False
+            self.update_status_icon()
+            QMessageBox.critical(self, "Error", f"Download failed: {str(e)}\n\n"
+                                 "The download queue is kept, you can start again.")
+
+    def pause_download(self):
+        self.dm.pause()
+        self.progress_dialog.set_paused(True)
+
+    def resume_download(self):
+        if not self.dm.paused:
+            return
+        self.dm.resume()
+        self.progress_dialog.set_paused(False)
+        self.step_download()
+
+    def cancel_download(self):
+        was_paused = self.dm.paused
+        self.dm.cancel()
+        if was_paused:
+            # Nothing is stepping the generator anymore, drive it to the end
+            self.step_download()
+
+    def verify_download_directory(self):
+        directory = QFileDialog.getExistingDirectory(
+            self, "Select Download Directory to Verify", self.get_download_path())
+        if not directory:
+            return
+        index = DownloadIndex(directory)
+        if not index.exists():
+            QMessageBox.warning(self, "Nothing to Verify",
+                                "This directory has no record of downloaded files.")
+            return
+
+        self.verify_report = VerifyReport()
+        self.verify_index = index
+        self.verifier = verify_generator(index, self.verify_report)
+        self.verify_dialog = QProgressDialog("Hashing files...", "Cancel", 0, 0, self)
+        self.verify_dialog.setWindowTitle("Verify Download")
+        self.verify_dialog.setWindowModality(Qt.ApplicationModal)
+        self.verify_dialog.setMinimumDuration(0)
+        self.verify_dialog.setAutoReset(False)
+        self.verify_dialog.setAutoClose(False)
+        self.verify_dialog.canceled.connect(self.verifier.close)
+        self.busy = True
+        self.update_status_icon()
+        self.step_verify()
+
+    def step_verify(self):
+        try:
+            done, total = next(self.verifier)
+            self.verify_dialog.setMaximum(total)
+            self.verify_dialog.setValue(done)
+            QTimer.singleShot(0, self.step_verify)
+        except StopIteration:
+            cancelled = self.verify_dialog.wasCanceled()
+            self.verify_dialog.close()
+            self.busy = False
+            self.update_status_icon()
+            if not cancelled:
+                self._show_verify_report()
+
+    def _show_verify_report(self):
+        report = self.verify_report
+        bad_entries = report.bad_entries()
+        if not bad_entries:
+            QMessageBox.information(self, "Verify Download", report.summary())
+            return
+        if not self.connected:
+            QMessageBox.warning(self, "Verify Download",
+                                report.summary() + "\n\nLogin to download the bad files again.")
+            return
+        answer = QMessageBox.question(
+            self, "Verify Download",
+            report.summary() + f"\n\nDownload the {len(bad_entries)} bad files again?")
+        if answer == QMessageBox.Yes:
+            self.dm = DownloadManager(self.download_tree, self.conn, self.verify_index.base_path,
+                                      self.new_bandwidth_limiter())
+            self._start_download(self.dm.redownload_files_generator(bad_entries), clear_queue=False)
+
+    def show_preview(self, item, *args):
+        self.preview_image_id = None
+        self.preview_label.clear()
+        if item is None:
+            return
+        model = self.omero_tree.model
+        node = self.omero_tree.node_of(item)
+        if model.kinds[node] != IMAGE:
+            return
+        self.preview_image_id = model.ids[node]
+        data = self.omero_tree.thumbnails.get(self.preview_image_id)
+        if data is None:
+            self.preview_label.setText("Loading preview...")
+            self.omero_tree.thumbnails.request([self.preview_image_id])
+        else:
+            self._set_preview(data)
+
+    def _on_preview_ready(self, image_ids):
+        if self.preview_image_id in image_ids:
+            self._set_preview(self.omero_tree.thumbnails.get(self.preview_image_id))
+
+    def _set_preview(self, data):
+        pixmap = QPixmap()
+        if data is not None and pixmap.loadFromData(data):
+            self.preview_label.setPixmap(pixmap)
+        else:
+            self.preview_label.setText("No preview")
+
+    def _show_omero_tree_menu(self, pos):
+        item = self.omero_tree.itemAt(pos)
+        if item is None or self.busy:
+            return
+        node = self.omero_tree.node_of(item)
+        if self.omero_tree.model.kinds[node] != IMAGE:
+            return
+        menu = QMenu(self)
+        export_action = menu.addAction("Export as OME-Zarr...")
+        if menu.exec_(self.omero_tree.viewport().mapToGlobal(pos)) == export_action:
+            self.export_zarr(node)
+
+    def export_zarr(self, node):
+        try:
+            import zarr_export  # needs numpy and zarr, only loaded when used
+        except ImportError as e:
+            QMessageBox.critical(self, "Error", f"OME-Zarr export is not available: {str(e)}")
+            return
+
+        model = self.omero_tree.model
+        try:
+            pixels_info = self.conn.get_pixels_info(model.ids[node])
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to read the image: {str(e)}")
+            return
+
+        default_path = Path(self.get_download_path() or Path.home()) / f"{model.names[node]}.ome.zarr"
+        dlg = ZarrExportDialog(pixels_info, str(default_path), self)
+        if dlg.exec_() != QDialog.Accepted:
+            return
+        try:
+            export = zarr_export.ZarrExport(pixels_info, dlg.channels, dlg.z_range, dlg.t_range, dlg.level)
+        except ValueError as e:
+            QMessageBox.critical(self, "Error", str(e))
+            return
+
+        self.zarr_path = Path(dlg.output_path)
+        self.zarr_path_existed = self.zarr_path.exists()  # empty, checked by the dialog
+        group_id = model.group_of(node)
+        if group_id is None:
+            import omero_connection
+            group_id = omero_connection.ALL_GROUPS
+        self.zarr_exporter = export.export_generator(
+            self.conn, self.zarr_path, group_id, limiter=self.new_bandwidth_limiter())
+        self.zarr_dialog = QProgressDialog("Fetching tiles...", "Cancel", 0, 0, self)
+        self.zarr_dialog.setWindowTitle("Export OME-Zarr")
+        self.zarr_dialog.setWindowModality(Qt.ApplicationModal)
+        self.zarr_dialog.setMinimumDuration(0)
+        self.zarr_dialog.setAutoReset(False)
+        self.zarr_dialog.setAutoClose(False)
+        self.busy = True
+        self.update_status_icon()
+        self.step_zarr_export()
+
+    def step_zarr_export(self):
+        error = None
+        if self.zarr_dialog.wasCanceled():
+            self.zarr_exporter.close()
+            done = True
+        else:
+            try:
+                written, total = next(self.zarr_exporter)
+                self.zarr_dialog.setMaximum(total)
+                self.zarr_dialog.setValue(written)
+                done = False
+            except StopIteration:
+                done = True
+            except Exception as e:
+                error = e
+                done = True
+        if not done:
+            QTimer.singleShot(0, self.step_zarr_export)
+            return
+
+        cancelled = self.zarr_dialog.wasCanceled()
+        self.zarr_dialog.close()
+        self.busy = False
+        self.update_status_icon()
+        if cancelled or error is not None:
+            self._remove_zarr_export()
+        if error is not None:
+            QMessageBox.critical(self, "Error", f"Failed to export the image: {str(error)}")
+
+    def _remove_zarr_export(self):
+        """Never leaves a partial export, only removes what it created"""
+        if not self.zarr_path_existed:
+            shutil.rmtree(self.zarr_path, ignore_errors=True)
+            return
+        for child in self.zarr_path.iterdir():
+            if child.is_dir() and not child.is_symlink():
+                shutil.rmtree(child, ignore_errors=True)
+            else:
+                child.unlink(missing_ok=True)
+
+    def toggle_profiling(self):
+        if not PROFILER.enabled:
+            PROFILER.start()
+            self.profiling_action.setText("Stop Profiling and Save Report...")
+            return
+        PROFILER.stop()
+        self.profiling_action.setText("Start Profiling")
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save Profiling Report", "omero_client_profile.txt", "Text files (*.txt)")
+        if not path:
+            return
+        try:
+            PROFILER.write_report(path, APP_VERSION)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to save the profiling report: {str(e)}")
+
+    def save_download_queue(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save Download Queue", "download_queue.omeroqueue",
+            "Download queue (*.omeroqueue)")
+        if not path:
+            return
+        try:
+            self.download_tree.save_queue(path)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to save the download queue: {str(e)}")
+
+    def load_download_queue(self):
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Load Download Queue", "", "Download queue (*.omeroqueue)")
+        if not path:
+            return
+        try:
+            self.download_tree.load_queue(path)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to load the download queue: {str(e)}")
+        self.update_omero_tree_highlight()
 
     def browse_download_path(self):
         directory = QFileDialog.getExistingDirectory(self, "Select Download Directory")
@@ -453,45 +1454,150 @@ class MainWindow(QMainWindow):
         return self.path_edit.text()
     
     def refresh(self):
-        if self.connected:
-            self._on_experimentor_changed(self.user_combo.currentIndex())  
-            self.update_omero_tree_highlight()
+        if not self.connected:
+            return
+        if self.tree_loader is not None:
+            # Still loading, nothing complete to compare with
+            self._on_experimentor_changed(self.user_combo.currentIndex())
+            return
+        self._start_tree_loader(self.refresh_tree_generator())
+
+    @PROFILER.profile_phase("refresh")
+    def refresh_tree_generator(self):
+        """Fetches the whole hierarchy like populate_full_tree_generator, then
+        applies the differences at once. A cancelled refresh changes nothing.
+        """
+        hierarchy = {}  # {project_id: (name, {dataset_id: (name, {image_id: name})})}
+        for project in self._fetch_projects_generator():
+            if project is TREE_LOADER_WAIT:
+                yield project
+                continue
+            proj_id, proj_name, datasets = project
+            hierarchy[proj_id] = (proj_name, {ds_id: (ds_name, images)
+                                              for ds_id, ds_name, images in datasets})
+
+        renamed = {}  # {(kind, id): new name}
+        self.omero_tree.setUpdatesEnabled(False)
+        try:
+            self._apply_children(ROOT, PROJECT, hierarchy, renamed)
+        finally:
+            self.omero_tree.setUpdatesEnabled(True)
+        if renamed:
+            self.download_tree.rename_objects(renamed)
+
+    def _apply_children(self, parent, kind, children, renamed):
+        """Inserts, removes and renames the children of parent in the OMERO
+        tree to match children, leaving everything else (expansion,
+        selection, thumbnails) untouched.
+        """
+        tree = self.omero_tree
+        model = tree.model
+        existing = {model.ids[node]: node for node in model.child_nodes(parent)}
+        for node_id, node in existing.items():
+            if node_id not in children:
+                tree.remove_node(node)
+
+        for node_id, value in children.items():
+            name, grandchildren = (value, None) if kind == IMAGE else value
+            node = existing.get(node_id)
+            if node is None:
+                group_id = self.current_group_id if kind == PROJECT else None
+                node = tree.add_node(kind, node_id, name, parent, group_id)
+            elif model.names[node] != name:
+                tree.rename_node(node, name)
+                renamed[(kind, node_id)] = name
+            if grandchildren is not None:
+                child_kind = DATASET if kind == PROJECT else IMAGE
+                self._apply_children(node, child_kind, grandchildren, renamed)
         
 
     def populate_full_tree(self):
+        self._start_tree_loader(self.populate_full_tree_generator())
+
+    def _start_tree_loader(self, loader):
+        if self.tree_loader is not None:
+            self.tree_loader.close()  # drop a load still running for the previous view
         self.set_loading(True)
-        self.tree_loader = self.populate_full_tree_generator()
-        self.step_tree_loader()
+        self.tree_loader_paused = False
+        self.pause_load_btn.setText("Pause")
+        self.tree_loader = loader
+        self.step_tree_loader(self.tree_loader)
     
-    def step_tree_loader(self):
+    def step_tree_loader(self, loader=None):
+        if loader is None:
+            loader = self.tree_loader
+        if loader is not self.tree_loader or self.tree_loader_paused:
+            return  # stale callback or paused, toggle_pause_tree_loader restarts it
         try:
-            next(self.tree_loader)
-            QTimer.singleShot(0, self.step_tree_loader)
+            delay = TREE_LOADER_POLL_MS if next(loader) is TREE_LOADER_WAIT else 0
+            QTimer.singleShot(delay, lambda: self.step_tree_loader(loader))
         except StopIteration:
+            self.tree_loader = None
+            self.set_loading(False)
+            self.update_omero_tree_highlight()  # the queue may outlive the tree
+            self.omero_tree.request_visible_thumbnails()
+        except Exception as e:
+            self.tree_loader = None
             self.set_loading(False)
+            QMessageBox.critical(self, "Error", f"Failed to load the OMERO data: {str(e)}")
 
+    def toggle_pause_tree_loader(self):
+        if self.tree_loader is None:
+            return
+        self.tree_loader_paused = not self.tree_loader_paused
+        if self.tree_fetcher is not None:
+            self.tree_fetcher.set_paused(self.tree_loader_paused)
+        if self.tree_loader_paused:
+            self.pause_load_btn.setText("Resume")
+            self.spinner_label.setText("⏸ Paused")
+        else:
+            self.pause_load_btn.setText("Pause")
+            self.spinner_label.setText("⏳ Loading...")
+            self.step_tree_loader()
+
+    def cancel_tree_loader(self):
+        """Stop loading between two server calls, keeping what is already shown"""
+        if self.tree_loader is None:
+            return
+        self.tree_loader.close()
+        self.tree_loader = None
+        self.tree_loader_paused = False
+        self.set_loading(False)
 
+
+    @PROFILER.profile_phase("populate_full_tree_generator")
     def populate_full_tree_generator(self):
-        projects = self.conn.get_user_projects()  # {project_id: project_name}
-        for proj_id, proj_name in projects.items():
-            proj_item = QTreeWidgetItem(self.omero_tree)
-            proj_item.setText(0, proj_name)
-            proj_item.setData(0, 1, ('project', proj_id))
-            yield  # let UI breathe
-    
-            datasets = self.conn.get_dataset_from_projectID(proj_id)
-            for ds_id, ds_name in datasets.items():
-                ds_item = QTreeWidgetItem(proj_item)
-                ds_item.setText(0, ds_name)
-                ds_item.setData(0, 1, ('dataset', ds_id))
-                yield
-    
-                images = self.conn.get_images_from_datasetID(ds_id)
-                for img_id, img_name in images.items():
-                    img_item = QTreeWidgetItem(ds_item)
-                    img_item.setText(0, img_name)
-                    img_item.setData(0, 1, ('image', img_id))
-                    yield
+        """Inserts the fetched projects, one whole project per step"""
+        for project in self._fetch_projects_generator():
+            if project is TREE_LOADER_WAIT:
+                yield project
+                continue
+            proj_id, proj_name, datasets = project
+            self.omero_tree.add_project(proj_id, proj_name, datasets, self.current_group_id)
+            yield
+
+    def _fetch_projects_generator(self):
+        """Runs a TreeFetcher, yields the projects as they arrive and
+        TREE_LOADER_WAIT while the next one is not there.
+        """
+        fetcher = TreeFetcher(self.conn)
+        self.tree_fetcher = fetcher
+        fetcher.start()
+        try:
+            while True:
+                try:
+                    project = fetcher.results.get_nowait()
+                except queue.Empty:
+                    yield TREE_LOADER_WAIT
+                    continue
+                if project is None:
+                    break
+                yield project
+            if fetcher.error is not None:
+                raise fetcher.error
+        finally:
+            fetcher.cancel()
+            self.tree_fetcher = None
 
 
     def _create_menu(self):
@@ -503,12 +1609,38 @@ class MainWindow(QMainWindow):
         settings_action.triggered.connect(self.open_settings)
         settings_menu.addAction(settings_action)
 
+        tools_menu = menubar.addMenu("&Tools")
+        verify_action = QAction("Verify Download Directory...", self)
+        verify_action.triggered.connect(self.verify_download_directory)
+        tools_menu.addAction(verify_action)
+
+        tools_menu.addSeparator()
+        save_queue_action = QAction("Save Download Queue...", self)
+        save_queue_action.triggered.connect(self.save_download_queue)
+        tools_menu.addAction(save_queue_action)
+
+        load_queue_action = QAction("Load Download Queue...", self)
+        load_queue_action.triggered.connect(self.load_download_queue)
+        tools_menu.addAction(load_queue_action)
+
+        tools_menu.addSeparator()
+        self.profiling_action = QAction("Start Profiling", self)
+        self.profiling_action.triggered.connect(self.toggle_profiling)
+        tools_menu.addAction(self.profiling_action)
+        if PROFILER.enabled:  # started from the environment
+            self.profiling_action.setText("Stop Profiling and Save Report...")
+
         help_menu = menubar.addMenu("&Help")
         
         about_action = QAction("About", self)
         about_action.triggered.connect(self.show_about_dialog)
         help_menu.addAction(about_action)
 
+        timing_action = QAction("Startup Timing", self)
+        timing_action.triggered.connect(
+            lambda: QMessageBox.information(self, "Startup Timing", startup_report()))
+        help_menu.addAction(timing_action)
+
         login_action = QAction("Login", self)
         login_action.triggered.connect(self.login)
         session_menu.addAction(login_action)
@@ -546,9 +1678,14 @@ class MainWindow(QMainWindow):
         try:
             if dlg.exec_() == QDialog.Accepted:
                 self.token = dlg.token
-                self.conn = omero_connection.OmeroConnection('omero-cci-cli.gu.se', '4064', self.token)
-                self.download_tree.conn = self.conn
+                import omero_connection  # waits for _preload_omero if still running
+                self.conn = omero_connection.OmeroConnection(
+                    self.host, self.port, self.token,
+                    self.server_compression.get(self.host, omero_connection.COMPRESS_OFF))
+                self.download_tree.set_connection(self.conn)
+                self.omero_tree.thumbnails.set_connection(self.conn)
                 self.connected = True
+                self.connection_timer.start()
                 self._update_groups_and_user()
                 self.update_status_icon()
                 QMessageBox.information(self, "Connected", "Successfully connected to OMERO.")
@@ -557,7 +1694,9 @@ class MainWindow(QMainWindow):
 
     def disconnect(self):
         if self.connected:
+            self.connection_timer.stop()
             self.conn.kill_session()
+            self.omero_tree.thumbnails.set_connection(None)
             self.omero_tree.clear()
             self.download_tree.clear()
             self.group_combo.setEnabled(False)
@@ -573,14 +1712,32 @@ class MainWindow(QMainWindow):
 
 
     def open_settings(self):
-        dlg = SettingsDialog(self, self.host, self.port)
+        dlg = SettingsDialog(self, self.host, self.port,
+                             self.client_limit, self.job_limit, self.bandwidth_schedule,
+                             self.server_compression)
         if dlg.exec_() == QDialog.Accepted:
             self.host = dlg.host
             self.port = dlg.port
+            self.server_compression = dlg.compression
+            self.client_limit = dlg.client_limit
+            self.job_limit = dlg.job_limit
+            self.bandwidth_schedule = dlg.schedule
+            limit = self.new_bandwidth_limiter().limit()
             QMessageBox.information(
                 self, "Settings Saved",
-                f"Hostname: {self.host}\nPort: {self.port}"
+                f"Hostname: {self.host}\nPort: {self.port}\n"
+                f"Compression: {self._compression_label(self.host)}\n"
+                f"Bandwidth now: {format_rate(limit)}"
             )
+
+    def _compression_label(self, host):
+        mode = self.server_compression.get(host, "off")
+        return next(label for label, value in COMPRESSION_CHOICES if value == mode)
+
+    def new_bandwidth_limiter(self):
+        """Limiter of one transfer job, sharing the client bucket"""
+        schedule = BandwidthSchedule.parse(self.bandwidth_schedule, self.client_limit * MB or None)
+        return BandwidthLimiter(self.client_bucket, schedule, self.job_limit * MB or None)
             
     def update_status_icon(self):
         if self.connected and not self.busy:
@@ -604,8 +1761,12 @@ class MainWindow(QMainWindow):
         if is_loading:
             self.busy = True
             self.spinner_label.setText("⏳ Loading...")  # or show a spinner gif
+            self.pause_load_btn.show()
+            self.cancel_load_btn.show()
         else:
             self.spinner_label.setText("")
+            self.pause_load_btn.hide()
+            self.cancel_load_btn.hide()
             self.busy = False
             
         self.update_status_icon()
@@ -641,6 +1802,7 @@ class MainWindow(QMainWindow):
         group_name = self.group_combo.itemText(index)
         try:
             self.conn.setOmeroGroupName(group_name)
+            self.current_group_id = self.conn.get_current_group_id()
             self.load_experimentors()
             
             # Set experimentor combo to yourself
@@ -651,11 +1813,8 @@ class MainWindow(QMainWindow):
             self.user_combo.blockSignals(False)
     
             # Manually trigger experimentor change once
-            self._on_experimentor_changed(self.user_combo.currentIndex())            
-            
-            self.omero_tree.clear()
-            self.download_tree.clear()
-            self.populate_full_tree()
+            # The download queue is kept, its projects remember their own group
+            self._on_experimentor_changed(self.user_combo.currentIndex())
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to switch groups: {str(e)}")
             
@@ -668,7 +1827,6 @@ class MainWindow(QMainWindow):
         
     def _on_experimentor_changed(self, index):
         self.omero_tree.clear()
-        self.download_tree.clear()
         user_name = self.user_combo.itemText(index)
         if user_name == '':
             user_name = self.user_name
@@ -676,85 +1834,78 @@ class MainWindow(QMainWindow):
         
         self.populate_full_tree()
         
+    @PROFILER.profile_phase("update_omero_tree_highlight")
     def update_omero_tree_highlight(self):
-        for i in range(self.omero_tree.topLevelItemCount()):
-            proj_item = self.omero_tree.topLevelItem(i)
-            self._update_item_highlight_recursive(proj_item)
-
-    def _update_item_highlight_recursive(self, item):
-        if item.childCount() == 0:
-            included = self._is_in_download_tree(item)
-            self._set_item_color(item, Qt.green if included else Qt.white)
+        for proj_node in self.omero_tree.model.child_nodes():
+            self._update_item_highlight_recursive(proj_node)
+
+    def _update_item_highlight_recursive(self, node):
+        children = self.omero_tree.model.child_nodes(node)
+        if not children:
+            included = self._is_in_download_tree(node)
+            self._set_item_color(node, Qt.green if included else Qt.white)
             return included
     
-        total = item.childCount()
+        total = len(children)
         included_count = 0
     
-        for i in range(total):
-            child = item.child(i)
+        for child in children:
             if self._update_item_highlight_recursive(child):
                 included_count += 1
     
         if included_count == total:
-            self._set_item_color(item, self.color_full)
+            self._set_item_color(node, self.color_full)
             return True
         elif included_count > 0:
-            self._set_item_color(item, self.color_partial) 
+            self._set_item_color(node, self.color_partial) 
             return False
         else:
-            self._set_item_color(item, Qt.white)
+            self._set_item_color(node, Qt.white)
             return False
     
-    def _set_item_color(self, item, color):
+    def _set_item_color(self, node, color):
         brush = QBrush(color)
-        item.setBackground(0, brush)
+        self.omero_tree.items[node].setBackground(0, brush)
         
         
-    def _is_in_download_tree(self, omero_item, verbose=False):
-        o_type, o_id = omero_item.data(0, 1)
-        if verbose: print(f"Checking if {o_type} {o_id} is in download tree")
-    
-        for i in range(self.download_tree.topLevelItemCount()):
-            d_proj = self.download_tree.topLevelItem(i)
-            if self._tree_item_match(d_proj, o_type, o_id):
-                if verbose: print("Matched at project level")
-                return True
-            for j in range(d_proj.childCount()):
-                d_ds = d_proj.child(j)
-                if self._tree_item_match(d_ds, o_type, o_id):
-                    if verbose: print("Matched at dataset level")
-                    return True
-                for k in range(d_ds.childCount()):
-                    d_child = d_ds.child(k)
-                    if self._tree_item_match(d_child, o_type, o_id):
-                        if verbose: print("Matched at image/folder level")
-                        return True
-                    for l in range(d_child.childCount()):
-                        d_img = d_child.child(l)
-                        if self._tree_item_match(d_img, o_type, o_id):
-                            if verbose: print("Matched at deep image level")
-                            return True
-        return False
-    
-    def _tree_item_match(self, item, o_type, o_id):
-        d_type, d_id = item.data(0, 1)
-        return (d_type == o_type and d_id == o_id)
+    def _is_in_download_tree(self, omero_node):
+        model = self.omero_tree.model
+        return self.download_tree.model.contains(model.kinds[omero_node], model.ids[omero_node])
     
     def check_connection(self):
         if not self.busy and self.connected:
             if not self.conn.is_connected():
                 self.connected = False
+                self.connection_timer.stop()
                 self.update_status_icon()
                 QMessageBox.critical(self, "Error", "Lost the connection to the Omero server. \n Retry later.")
 
 
 class DownloadManager:
-    def __init__(self, download_tree, conn, base_path):
+    def __init__(self, download_tree, conn, base_path, limiter=None):
         self.download_tree = download_tree
-        self.conn = conn
+        self.model = download_tree.model  # HierarchyModel of the queue
+        self.conn = conn  # OmeroConnection
         self.base_path = Path(base_path)
         self.downloaded_filesets = set()  # Track downloaded fileset IDs
         self.progress_signals = None
+        self.paused = False
+        self.cancelled = False
+        if limiter is None:
+            limiter = BandwidthLimiter(TokenBucket(), BandwidthSchedule())
+        self.limiter = limiter
+
+    def pause(self):
+        """The generator is left suspended, no chunk is read until resume()"""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def cancel(self):
+        """Stop at the next chunk boundary, the partial file is removed"""
+        self.cancelled = True
+        self.paused = False
     
     def update_overall_progress(self, current, total):
         if self.progress_signals:
@@ -765,124 +1916,205 @@ class DownloadManager:
         if self.progress_signals:
             self.progress_signals.set_file_max(total)
             self.progress_signals.set_file_value(current)
+
+    def update_throughput(self):
+        if self.progress_signals:
+            meter = self.limiter.meter
+            self.progress_signals.set_throughput(meter.current(), self.limiter.limit())
                     
     def _collect_fileset_ids(self):
-        fileset_set = set()
-        for i in range(self.download_tree.topLevelItemCount()):
-            project_item = self.download_tree.topLevelItem(i)
-            for j in range(project_item.childCount()):
-                dataset_item = project_item.child(j)
-                for k in range(dataset_item.childCount()):
-                    child_item = dataset_item.child(k)
-                    if child_item is None:
-                        continue
-                    data = child_item.data(0, 1)
-                    if data is None:
-                        continue
-                    node_type, node_id = data
-                    if node_type == 'folder':
-                        for l in range(child_item.childCount()):
-                            image_item = child_item.child(l)
-                            if image_item is None:
-                                continue
-                            image_data = image_item.data(0, 1)
-                            if image_data is None:
-                                continue
-                            node_type, image_id = image_data
-                            fileset = self.conn.get_fileset_from_imageID(image_id)
-                            if fileset:
-                                fileset_set.add(fileset.getId())
-                    elif node_type == 'image':
-                        image_id = node_id
-                        fileset = self.conn.get_fileset_from_imageID(image_id)
-                        if fileset:
-                            fileset_set.add(fileset.getId())
-        return list(fileset_set)
+        return asyncio.run(self._collect_fileset_ids_async())
+
+    async def _collect_fileset_ids_async(self):
+        # All the lookups are sent at once, the connection limits the concurrency
+        model = self.model
+        aio = self.conn.aio
+        filesets = await asyncio.gather(*(
+            aio.get_fileset_from_imageID(model.ids[image], self._get_group_id(project))
+            for project in model.child_nodes() for image in model.iter_images(project)))
+        return list({fileset.getId() for fileset in filesets if fileset})
+
+    def _get_group_id(self, project):
+        import omero_connection
+        group_id = self.model.groups.get(project)
+        return omero_connection.ALL_GROUPS if group_id is None else group_id
         
+    @PROFILER.profile_phase("download_files_generator")
     def download_files_generator(self):
         if not self.base_path.exists():
             self.base_path.mkdir(parents=True, exist_ok=True)
+        self.index = DownloadIndex(self.base_path)
     
         all_fileset_ids = self._collect_fileset_ids()
         self.total_files = len(all_fileset_ids)
         self.files_downloaded = 0
         self.update_overall_progress(self.files_downloaded, self.total_files)
     
-        for i in range(self.download_tree.topLevelItemCount()):
-            project_item = self.download_tree.topLevelItem(i)
-            yield from self._download_project_generator(project_item, self.base_path)
+        for project in self.model.child_nodes():
+            if self.cancelled:
+                return
+            yield from self._download_project_generator(
+                project, self.base_path, self._get_group_id(project))
     
         yield "done"
     
     
-    def _download_project_generator(self, project_item, current_path):
-        project_name = project_item.text(0)
-        project_path = current_path / project_name
+    def _download_project_generator(self, project, current_path, group_id):
+        project_path = current_path / self.model.names[project]
         project_path.mkdir(exist_ok=True)
     
-        for i in range(project_item.childCount()):
-            dataset_item = project_item.child(i)
-            yield from self._download_dataset_generator(dataset_item, project_path)
+        for dataset in self.model.child_nodes(project):
+            if self.cancelled:
+                return
+            yield from self._download_dataset_generator(dataset, project_path, group_id)
     
     
-    def _download_dataset_generator(self, dataset_item, current_path):
-        dataset_name = dataset_item.text(0)
-        dataset_path = current_path / dataset_name
+    def _download_dataset_generator(self, dataset, current_path, group_id):
+        model = self.model
+        dataset_path = current_path / model.names[dataset]
         dataset_path.mkdir(exist_ok=True)
     
-        for i in range(dataset_item.childCount()):
-            child_item = dataset_item.child(i)
-            node_type, node_id = child_item.data(0, 1)
-            if node_type == 'folder':
-                folder_name = child_item.text(0)
-                folder_path = dataset_path / folder_name
+        for child in model.child_nodes(dataset):
+            if self.cancelled:
+                return
+            if model.kinds[child] == FOLDER:
+                folder_path = dataset_path / model.names[child]
                 folder_path.mkdir(exist_ok=True)
-                for j in range(child_item.childCount()):
-                    image_item = child_item.child(j)
-                    yield from self._download_image_generator(image_item, folder_path)
-            elif node_type == 'image':
-                yield from self._download_image_generator(child_item, dataset_path)
+                for image in model.child_nodes(child):
+                    if self.cancelled:
+                        return
+                    yield from self._download_image_generator(image, folder_path, group_id)
+            elif model.kinds[child] == IMAGE:
+                yield from self._download_image_generator(child, dataset_path, group_id)
     
     
-    def _download_image_generator(self, image_item, current_path):
-        image_name = image_item.text(0)
-        node_type, image_id = image_item.data(0, 1)
+    def _download_image_generator(self, image, current_path, group_id):
+        if self.cancelled:
+            return  # before any server call
+        image_name = self.model.names[image]
+        image_id = self.model.ids[image]
     
-        fileset = self.conn.get_fileset_from_imageID(image_id)
+        fileset = self.conn.get_fileset_from_imageID(image_id, group_id)
         if fileset is None:
             print(f"No fileset for image {image_name} (ID: {image_id})")
             return
     
         fileset_id = fileset.getId()
-        if fileset_id in self.downloaded_filesets:
-            return
     
         for orig_file in fileset.listFiles():
+            if self.cancelled:
+                return
+            file_id = orig_file.getId()
+            file_hash = orig_file.getHash()
             file_name = orig_file.getName()
             file_path = current_path / file_name
             file_size = orig_file.getSize()
             self.update_file_progress(0, file_size)
-    
-            with open(file_path, 'wb') as f:
+
+            # Same file already downloaded somewhere in the target tree
+            hasher = self._get_hasher_name(orig_file)
+            existing_path = self.index.find(file_id, file_hash, file_size, hasher)
+            if existing_path is not None:
+                if existing_path != file_path:
+                    file_path.unlink(missing_ok=True)
+                    self._link_file(existing_path, file_path)
+                    self.index.add(file_id, file_hash, file_size, file_path, hasher, group_id)
+                self.update_file_progress(file_size, file_size)
+                yield
+                continue
+
+            yield from self._transfer_file_generator(file_id, file_size, group_id, file_path)
+            if self.cancelled:
+                return
+            self.index.add(file_id, file_hash, file_size, file_path, hasher, group_id)
+            yield
+
+        # An image linked in several datasets gets its files linked there too,
+        # but only counts once in the overall progress
+        if fileset_id not in self.downloaded_filesets:
+            self.downloaded_filesets.add(fileset_id)
+            self.files_downloaded += 1
+            self.update_overall_progress(self.files_downloaded, self.total_files)
+        yield
+
+    def _transfer_file_generator(self, file_id, file_size, group_id, file_path):
+        """Yields after every chunk the seconds to wait for the bandwidth limit"""
+        part_path = file_path.with_name(file_path.name + PARTIAL_SUFFIX)
+        self.update_file_progress(0, file_size)
+
+        # Write to a .part file, so an interrupted transfer never looks complete
+        completed = False
+        chunks = self.conn.get_file_in_chunks(
+            file_id, file_size, group_id, self.limiter.chunk_size(TRANSFER_CHUNK_SIZE))
+        try:
+            with open(part_path, 'wb') as f:
                 bytes_written = 0
-                for chunk in orig_file.getFileInChunks():
+                for chunk in chunks:
                     f.write(chunk)
                     bytes_written += len(chunk)
+                    delay = self.limiter.consume(len(chunk))
                     self.update_file_progress(bytes_written, file_size)
-                    yield
-    
-            self.downloaded_filesets.add(fileset_id)
+                    self.update_throughput()
+                    yield delay
+                    if self.cancelled:
+                        return
+            completed = True
+        finally:
+            chunks.close()  # release the server side file store
+            if not completed:
+                part_path.unlink(missing_ok=True)
+        part_path.replace(file_path)
+
+    def redownload_files_generator(self, entries):
+        """Transfers again the given index entries, e.g. from a VerifyReport"""
+        self.index = DownloadIndex(self.base_path)
+        self.total_files = len(entries)
+        self.files_downloaded = 0
+        self.update_overall_progress(self.files_downloaded, self.total_files)
+
+        for entry in entries:
+            if self.cancelled:
+                return
+            file_path = self.base_path / entry['path']
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            group_id = entry.get('group')
+            if group_id is None:
+                import omero_connection
+                group_id = omero_connection.ALL_GROUPS
+            yield from self._transfer_file_generator(entry['id'], entry['size'], group_id, file_path)
+            if self.cancelled:
+                return
+            self.index.add(entry['id'], entry['hash'], entry['size'], file_path,
+                           entry.get('hasher'), entry.get('group'))
             self.files_downloaded += 1
             self.update_overall_progress(self.files_downloaded, self.total_files)
-            yield        
+            yield
+
+    def _get_hasher_name(self, orig_file):
+        hasher = orig_file._obj.getHasher()
+        if hasher is None or not hasher.isLoaded():
+            return None
+        return hasher.getValue().getValue()
+
+    def _link_file(self, source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            # File system without hard links, at least the transfer is saved
+            shutil.copy2(source, target)
 
 
 class DownloadProgressDialog(QDialog):
+    pauseRequested = pyqtSignal()
+    resumeRequested = pyqtSignal()
+    cancelRequested = pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Download Progress")
         self.setWindowModality(Qt.ApplicationModal)  # Modal window
-        self.setFixedSize(400, 120)
+        self.setFixedSize(400, 190)
+        self.paused = False
 
         self.overall_progress = QProgressBar()
         self.overall_progress.setFormat("Overall Progress: %v/%m files")
@@ -892,11 +2124,42 @@ class DownloadProgressDialog(QDialog):
         self.file_progress.setFormat("Current File Progress: %p%")
         self.file_progress.setAlignment(Qt.AlignCenter)
 
+        self.throughput_label = QLabel()
+        self.throughput_label.setAlignment(Qt.AlignCenter)
+
+        self.pause_btn = QPushButton("Pause")
+        self.pause_btn.clicked.connect(self._toggle_pause)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.clicked.connect(self.reject)
+
+        btn_layout = QHBoxLayout()
+        btn_layout.addWidget(self.pause_btn)
+        btn_layout.addWidget(self.cancel_btn)
+
         layout = QVBoxLayout()
         layout.addWidget(self.overall_progress)
         layout.addWidget(self.file_progress)
+        layout.addWidget(self.throughput_label)
+        layout.addLayout(btn_layout)
         self.setLayout(layout)
 
+    def _toggle_pause(self):
+        if self.paused:
+            self.resumeRequested.emit()
+        else:
+            self.pauseRequested.emit()
+
+    def set_paused(self, paused):
+        self.paused = paused
+        self.pause_btn.setText("Resume" if paused else "Pause")
+
+    def reject(self):
+        # Cancel button, Esc and the window close button all end up here
+        self.cancel_btn.setEnabled(False)
+        self.pause_btn.setEnabled(False)
+        self.cancel_btn.setText("Cancelling...")
+        self.cancelRequested.emit()
+
     def set_overall_max(self, max_files):
         self.overall_progress.setMaximum(max_files)
 
@@ -909,6 +2172,9 @@ class DownloadProgressDialog(QDialog):
     def set_file_value(self, value):
         self.file_progress.setValue(value)
 
+    def set_throughput(self, rate, limit):
+        self.throughput_label.setText(f"{rate / MB:.1f} MB/s (limit: {format_rate(limit)})")
+
 
 
 
@@ -916,5 +2182,6 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon("icons/icon.png"))
     window = MainWindow()
+    mark_startup("Main window built")
     window.show()
     sys.exit(app.exec_())
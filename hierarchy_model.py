@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Compact project/dataset/folder/image hierarchy shared by the OMERO tree,
+the download queue and the download engine.
+
+Nodes are integer indexes into flat arrays instead of Python objects, the
+Qt items only store their node index.
+"""
+
+from array import array
+
+PROJECT, DATASET, FOLDER, IMAGE = range(4)
+
+ROOT = -1  # parent of the projects
+
+
+class HierarchyModel:
+    """Node n is described by kinds[n], ids[n], names[n] and parents[n].
+
+    Folders have no OMERO id, they are identified by their name within their
+    dataset. Removed nodes are unlinked and their slot is left unused, so node
+    indexes stay valid until clear().
+    """
+    __slots__ = ('kinds', 'ids', 'parents', 'names', 'children', 'groups',
+                 '_lookup', '_counts')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.kinds = array('b')
+        self.ids = array('q')
+        self.parents = array('l')
+        self.names = []
+        self.children = {ROOT: []}  # {node: [child nodes]}, leaves have no entry
+        self.groups = {}            # {project node: OMERO group id}
+        self._lookup = {}           # {(parent, kind, id): node}
+        self._counts = {}           # {(kind, id): number of nodes}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def node_id(self, node):
+        """OMERO id of the node, or its name for a folder"""
+        if self.kinds[node] == FOLDER:
+            return self.names[node]
+        return self.ids[node]
+
+    def child_nodes(self, node=ROOT):
+        return self.children.get(node, ())
+
+    def add(self, kind, node_id, name, parent=ROOT, group_id=None):
+        node = len(self.kinds)
+        self.kinds.append(kind)
+        self.ids.append(0 if kind == FOLDER else node_id)
+        self.parents.append(parent)
+        self.names.append(name)
+        self.children.setdefault(parent, []).append(node)
+        if group_id is not None:
+            self.groups[node] = group_id
+        self._lookup[(parent, kind, node_id)] = node
+        if kind != FOLDER:
+            key = (kind, node_id)
+            self._counts[key] = self._counts.get(key, 0) + 1
+        return node
+
+    def find_child(self, parent, kind, node_id):
+        return self._lookup.get((parent, kind, node_id))
+
+    def contains(self, kind, node_id):
+        """True if an OMERO object is anywhere in the hierarchy"""
+        return (kind, node_id) in self._counts
+
+    def remove(self, node):
+        """Unlinks the node and its whole subtree"""
+        self.children[self.parents[node]].remove(node)
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            stack.extend(self.children.pop(current, ()))
+            self.groups.pop(current, None)
+            kind = self.kinds[current]
+            node_id = self.node_id(current)
+            del self._lookup[(self.parents[current], kind, node_id)]
+            if kind != FOLDER:
+                key = (kind, node_id)
+                if self._counts[key] == 1:
+                    del self._counts[key]
+                else:
+                    self._counts[key] -= 1
+
+    def ancestor(self, node, kind):
+        """The closest node of the given kind, the node itself included"""
+        while node != ROOT and self.kinds[node] != kind:
+            node = self.parents[node]
+        return None if node == ROOT else node
+
+    def group_of(self, node):
+        project = self.ancestor(node, PROJECT)
+        return None if project is None else self.groups.get(project)
+
+    def iter_subtree(self, node):
+        """The node and all its descendants"""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            yield current
+            stack.extend(self.child_nodes(current))
+
+    def iter_images(self, node=ROOT):
+        """Image nodes of a subtree, in tree order"""
+        if node != ROOT and self.kinds[node] == IMAGE:
+            yield node
+            return
+        stack = list(reversed(self.child_nodes(node)))
+        while stack:
+            current = stack.pop()
+            if self.kinds[current] == IMAGE:
+                yield current
+            else:
+                stack.extend(reversed(self.child_nodes(current)))
@@ -8,13 +8,37 @@ port:'4064'
 'omero-cci-cli.gu.se'
 """
 
-from omero.gateway import BlitzGateway
+import asyncio
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import omero.clients
+from omero.gateway import BlitzGateway, FilesetWrapper
+from omero.sys import ParametersI
+from omero.rtypes import rlist, rlong, unwrap
+
+# -1 lets a query look into every group the user is a member of
+ALL_GROUPS = -1
+
+# Ice protocol compression: none, for the metadata calls only, or also for
+# the file and pixel transfers. Compressing bulk data costs more CPU than it
+# saves on a fast link, and most image files hardly compress.
+COMPRESS_OFF = "off"
+COMPRESS_METADATA = "metadata"
+COMPRESS_ALL = "all"
+COMPRESSION_MODES = (COMPRESS_OFF, COMPRESS_METADATA, COMPRESS_ALL)
 
 
 class OmeroConnection:
        
-    def __init__(self, hostname, port, token):
+    def __init__(self, hostname, port, token, compression=COMPRESS_OFF):
+        self.conn = None
+        self.compression = compression
+        self._transfer_client = None  # own client when only metadata is compressed
+        self._transfer_lock = threading.Lock()
         self._connect_to_omero(hostname, port, token)
+        self.aio = AsyncOmeroConnection(self)
         
     def __del__(self):
         self._close_omero_connection()
@@ -27,14 +51,58 @@ class OmeroConnection:
 
     def _connect_to_omero(self, hostname, port, token):
         self.omero_token = token
+        self.hostname = hostname
+        self.port = port
 
-        self.conn = BlitzGateway(host=hostname, port=port)
-        is_connected = self.conn.connect(token)
-    
-        if not is_connected:
+        compress = self.compression in (COMPRESS_METADATA, COMPRESS_ALL)
+        client = self._new_client(compress)
+        try:
+            client.joinSession(token)
+        except Exception as e:
+            client.closeSession()  # destroys the communicator
+            raise ConnectionError(f"Failed to connect to OMERO: {e}") from e
+
+        # Wrapped as is: connect() would replace the client by a default one,
+        # dropping the Ice properties
+        self.conn = BlitzGateway(client_obj=client)
+        if not self.conn.isConnected():
             raise ConnectionError("Failed to connect to OMERO")
 
+    def _new_client(self, compress):
+        # Ice.Override.Compress applies to every proxy of the communicator
+        pmap = {'Ice.Override.Compress': '1'} if compress else {}
+        return omero.client(host=self.hostname, port=int(self.port), pmap=pmap)
+
+    def _transfer_session(self):
+        """Service factory for the file and pixel stores.
+
+        With COMPRESS_METADATA the transfers go through a second client
+        without compression, joined to the same session.
+        """
+        if self.compression != COMPRESS_METADATA:
+            return self.conn.c.sf
+        with self._transfer_lock:
+            if self._transfer_client is None:
+                client = self._new_client(False)
+                client.joinSession(self.conn.c.getSessionId())
+                self._transfer_client = client
+            return self._transfer_client.sf
+
+    def get_compression_in_effect(self):
+        """(metadata, transfers), read back from the Ice communicators"""
+        def compressed(client):
+            properties = client.getCommunicator().getProperties()
+            return properties.getPropertyAsInt('Ice.Override.Compress') == 1
+
+        self._transfer_session()
+        return compressed(self.conn.c), compressed(self._transfer_client or self.conn.c)
+
     def _close_omero_connection(self,hardClose=False):
+        if getattr(self, 'aio', None):
+            self.aio.close()
+        if getattr(self, '_transfer_client', None):
+            self._transfer_client.closeSession()  # only leaves the joined session
+            self._transfer_client = None
         if self.conn:
             self.conn.close(hard=hardClose)
        
@@ -57,6 +125,15 @@ class OmeroConnection:
     def setOmeroGroupName(self, group):
         self.conn.setGroupNameForSession(group)
 
+    def get_current_group_id(self):
+        return self.conn.getEventContext().groupId
+
+    def _group_context(self, group_id):
+        # Per-call context, leaves the group of the session untouched
+        ctx = self.conn.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(str(group_id))
+        return ctx
+
     def get_user_projects(self):
         projects = {}
         my_expId = self.conn.getUser().getId()
@@ -94,11 +171,88 @@ class OmeroConnection:
             folder =  'uploads' #fallback
         return folder
     
-    def get_fileset_from_imageID(self, image_id):
-        #get the image object
-        image = self.conn.getObject("Image", image_id)
-        return image.getFileset()
+    def get_fileset_from_imageID(self, image_id, group_id=ALL_GROUPS):
+        params = ParametersI()
+        params.addId(image_id)
+        fileset = self.conn.getQueryService().findByQuery(
+            "select fs from Fileset fs"
+            " left outer join fetch fs.usedFiles as uf"
+            " left outer join fetch uf.originalFile as f"
+            " left outer join fetch f.hasher"
+            " where fs.id = (select i.fileset.id from Image i where i.id = :id)",
+            params, self._group_context(group_id))
+        if fileset is None:
+            return None
+        return FilesetWrapper(self.conn, fileset)
+
+    def get_fileset_sizes_from_imageIDs(self, image_ids, group_id=ALL_GROUPS):
+        """Returns {image_id: (fileset_id, total_bytes, file_count)} in one call"""
+        params = ParametersI()
+        params.add('ids', rlist([rlong(i) for i in image_ids]))
+        rows = self.conn.getQueryService().projection(
+            "select i.id, fs.id, sum(f.size), count(f.id) from Image i"
+            " join i.fileset fs join fs.usedFiles uf join uf.originalFile f"
+            " where i.id in (:ids) group by i.id, fs.id",
+            params, self._group_context(group_id))
+        sizes = {}
+        for row in rows:
+            image_id, fileset_id, total_bytes, file_count = unwrap(row)
+            sizes[image_id] = (fileset_id, total_bytes or 0, file_count)
+        return sizes
+
+    def get_file_in_chunks(self, file_id, file_size, group_id=ALL_GROUPS, buf=2621440):
+        """Same as OriginalFileWrapper.getFileInChunks but in the given group"""
+        store = self._transfer_session().createRawFileStore()
+        try:
+            store.setFileId(file_id, self._group_context(group_id))
+            pos = 0
+            while pos < file_size:
+                size = min(buf, file_size - pos)
+                yield store.read(pos, size)
+                pos += size
+        finally:
+            store.close()
     
+    def get_pixels_info(self, image_id):
+        """Dimensions, channels and resolution levels of an image"""
+        image = self.conn.getObject("Image", image_id)
+        if not image:
+            raise Exception(f"Image with ID {image_id} not found")
+        pixels_id = image.getPrimaryPixels().getId()
+
+        store = self.create_raw_pixels_store(pixels_id)
+        try:
+            # Full resolution first
+            levels = [(d.sizeX, d.sizeY) for d in store.getResolutionDescriptions()]
+            tile_size = tuple(store.getTileSize())
+        finally:
+            store.close()
+
+        return {
+            'name': image.getName(),
+            'pixels_id': pixels_id,
+            'pixel_type': image.getPixelsType(),
+            'size_c': image.getSizeC(),
+            'size_z': image.getSizeZ(),
+            'size_t': image.getSizeT(),
+            'channels': image.getChannelLabels(),
+            'levels': levels,
+            'tile_size': tile_size,
+            'physical_size': (image.getPixelSizeZ(), image.getPixelSizeY(), image.getPixelSizeX()),
+        }
+
+    def create_raw_pixels_store(self, pixels_id, level=0, group_id=ALL_GROUPS):
+        """Level 0 is the full resolution, OMERO numbers the levels the other way round"""
+        ctx = self._group_context(group_id)
+        store = self._transfer_session().createRawPixelsStore()
+        store.setPixelsId(pixels_id, False, ctx)
+        store.setResolutionLevel(store.getResolutionLevels() - 1 - level, ctx)
+        return store
+
+    def get_thumbnail_set(self, image_ids, size):
+        """{image_id: JPEG bytes}, the longest side scaled to size"""
+        return self.conn.getThumbnailSet(image_ids, max_size=size)
+
     def get_members_of_group(self):
         colleagues = {}
         for idx in self.conn.listColleagues():
@@ -114,6 +268,84 @@ class OmeroConnection:
     def is_connected(self):
         return self.conn.isConnected()
 
+class AsyncOmeroConnection:
+    """Awaitable versions of the OmeroConnection calls.
+
+    The blocking calls run on a thread pool sharing the session of the
+    connection, at most max_concurrency at once per event loop. The timeout
+    of a call starts when it runs, not while it waits for a free slot.
+    Identical calls already in flight, in the same group, are shared instead
+    of being sent again. A timed out call is not interrupted on the server,
+    it keeps its slot until it returns.
+    """
+
+    def __init__(self, omero_conn, max_concurrency=8, timeout=60):
+        self.omero_conn = omero_conn
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # Several event loops may share the pool (asyncio.run on the GUI
+        # thread, the tree fetcher), room for the calls left by timeouts
+        self._executor = ThreadPoolExecutor(max_workers=2 * max_concurrency,
+                                            thread_name_prefix="omero")
+        self._semaphores = weakref.WeakKeyDictionary()  # {loop: asyncio.Semaphore}
+        self._in_flight = {}  # {(loop, group, method, args): asyncio task}
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _call(self, method, *args, timeout=None):
+        loop = asyncio.get_running_loop()
+        group = self.omero_conn.conn.SERVICE_OPTS.getOmeroGroup()
+        key = (loop, group, method, args)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = loop.create_task(self._run(method, args, timeout or self.timeout))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._in_flight.pop(key, None))
+        # Shielded: a caller going away must not cancel the call shared with others
+        return await asyncio.shield(task)
+
+    async def _run(self, method, args, timeout):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        await semaphore.acquire()
+
+        started = loop.create_future()
+
+        def run():
+            loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+            return getattr(self.omero_conn, method)(*args)
+
+        future = loop.run_in_executor(self._executor, run)
+        # The slot is given back when the thread is done, even after a timeout
+        future.add_done_callback(lambda f: semaphore.release())
+        await asyncio.wait({started, future}, return_when=asyncio.FIRST_COMPLETED)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"OMERO call {method}{args} did not answer within {timeout} s")
+
+    async def get_user_projects(self, timeout=None):
+        return await self._call('get_user_projects', timeout=timeout)
+
+    async def get_dataset_from_projectID(self, project_id, timeout=None):
+        return await self._call('get_dataset_from_projectID', project_id, timeout=timeout)
+
+    async def get_images_from_datasetID(self, dataset_id, timeout=None):
+        return await self._call('get_images_from_datasetID', dataset_id, timeout=timeout)
+
+    async def get_original_upload_folder(self, image_id, timeout=None):
+        return await self._call('get_original_upload_folder', image_id, timeout=timeout)
+
+    async def get_fileset_from_imageID(self, image_id, group_id=ALL_GROUPS, timeout=None):
+        return await self._call('get_fileset_from_imageID', image_id, group_id, timeout=timeout)
+
+    async def get_members_of_group(self, timeout=None):
+        return await self._call('get_members_of_group', timeout=timeout)
+
+
 if __name__ == "__main__":
     Conn = OmeroConnection('omero-cci-cli.gu.se', '4064', '9222b398-095d-488e-b7fd-4d7745dd6bff')
     
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the slow phases of the client (tree loading, queueing,
+highlighting, downloads).
+
+Turned on with Tools > Start Profiling, or for a whole run by setting
+OMERO_CLIENT_PROFILE to the path of the report to write at exit. The report
+is a single text file with the wall and CPU time of every phase and the
+cProfile statistics of the functions called during them.
+"""
+
+import io
+import sys
+import time
+import atexit
+import cProfile
+import inspect
+import os
+import platform
+import pstats
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+PROFILE_ENV = "OMERO_CLIENT_PROFILE"
+
+
+class Profiler:
+    """Records wall time, CPU time and calls per phase, with one cProfile
+    collector enabled only while a phase runs. Does nothing until started.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}  # {name: [calls, wall seconds, cpu seconds]}
+        self._profile = None
+        self._depth = 0
+        self._started = None
+        self._lock = threading.Lock()  # phases are also recorded by worker threads
+
+    def start(self):
+        self.phases = {}
+        self._profile = cProfile.Profile()
+        self._started = time.time()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        outermost = self._depth == 0
+        self._depth += 1
+        if outermost:
+            self._profile.enable()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            self._depth -= 1
+            if outermost:
+                self._profile.disable()
+            self._record(name, wall, cpu)
+
+    @contextmanager
+    def timed(self, name):
+        """Wall and CPU time only, for phases running on a worker thread
+        where the cProfile collector of the GUI thread does not apply.
+        """
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def _record(self, name, wall, cpu):
+        with self._lock:
+            stats = self.phases.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+
+    def profile_phase(self, name):
+        """Decorator, a generator function is timed step by step, so the
+        time spent in the event loop between two steps is not counted.
+
+        Surplus positional arguments are dropped like PyQt does for a plain
+        slot, so a decorated method can stay connected to a signal sending
+        more arguments than it takes (e.g. the item of itemDoubleClicked).
+        """
+        def decorator(func):
+            max_args = _max_positional_args(func)
+            if inspect.isgeneratorfunction(func):
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    return self._profiled_generator(name, func(*args[:max_args], **kwargs))
+            else:
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.phase(name):
+                        return func(*args[:max_args], **kwargs)
+            return wrapper
+        return decorator
+
+    def _profiled_generator(self, name, generator):
+        try:
+            while True:
+                with self.phase(name):
+                    try:
+                        value = next(generator)
+                    except StopIteration as stop:
+                        return stop.value
+                yield value
+        finally:
+            generator.close()
+
+    def write_report(self, path, app_version=""):
+        lines = [
+            f"OMERO download client {app_version} profile",
+            f"Recorded: {time.ctime(self._started)} to {time.ctime()}",
+            f"Python {sys.version.split()[0]} on {platform.platform()}",
+            "",
+            f"{'Phase':<32}{'calls':>10}{'wall [s]':>12}{'cpu [s]':>12}",
+        ]
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda p: -p[1][1])
+        for name, (calls, wall, cpu) in phases:
+            lines.append(f"{name:<32}{calls:>10}{wall:>12.3f}{cpu:>12.3f}")
+        lines += ["", "CPU time is the one of the thread running the phase. Phases marked",
+                  "(worker) run on a background thread and are not in the statistics below.", ""]
+
+        stream = io.StringIO()
+        if self.phases:
+            stats = pstats.Stats(self._profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(80)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines))
+            f.write(stream.getvalue())
+
+
+def _max_positional_args(func):
+    """Number of positional arguments func takes, None if unbounded"""
+    parameters = inspect.signature(func).parameters.values()
+    if any(p.kind == p.VAR_POSITIONAL for p in parameters):
+        return None
+    return sum(p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD) for p in parameters)
+
+
+PROFILER = Profiler()
+
+if os.environ.get(PROFILE_ENV):
+    PROFILER.start()
+    atexit.register(lambda: PROFILER.write_report(os.environ[PROFILE_ENV]))
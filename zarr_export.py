@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Export of a region of an image (channels, Z/T ranges, resolution level) as
+OME-Zarr, fetching only the pixels needed instead of the original fileset.
+
+Tiles are read in parallel, each worker thread with its own RawPixelsStore,
+and written to the chunked Zarr array as they arrive.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import zarr
+
+import omero_connection
+
+# OMERO pixel types, as sent by the server (big endian)
+PIXEL_TYPES = {
+    'int8': '>i1',
+    'uint8': '>u1',
+    'int16': '>i2',
+    'uint16': '>u2',
+    'int32': '>i4',
+    'uint32': '>u4',
+    'float': '>f4',
+    'double': '>f8',
+}
+
+
+class ZarrExport:
+    """What to export from an image, see OmeroConnection.get_pixels_info"""
+
+    def __init__(self, pixels_info, channels=None, z_range=None, t_range=None, level=0):
+        self.info = pixels_info
+        self.channels = list(range(pixels_info['size_c'])) if channels is None else list(channels)
+        self.z_range = (0, pixels_info['size_z']) if z_range is None else z_range  # [start, stop)
+        self.t_range = (0, pixels_info['size_t']) if t_range is None else t_range
+        self.level = level
+        if pixels_info['pixel_type'] not in PIXEL_TYPES:
+            raise ValueError(f"Pixel type {pixels_info['pixel_type']} can not be exported")
+
+    def shape(self):
+        size_x, size_y = self.info['levels'][self.level]
+        return (self.t_range[1] - self.t_range[0], len(self.channels),
+                self.z_range[1] - self.z_range[0], size_y, size_x)
+
+    def tiles(self):
+        """(z, c, t, x, y, w, h) of every tile to fetch, in OMERO coordinates"""
+        size_x, size_y = self.info['levels'][self.level]
+        tile_w, tile_h = self.info['tile_size']
+        for t in range(*self.t_range):
+            for c in self.channels:
+                for z in range(*self.z_range):
+                    for y in range(0, size_y, tile_h):
+                        for x in range(0, size_x, tile_w):
+                            yield z, c, t, x, y, min(tile_w, size_x - x), min(tile_h, size_y - y)
+
+    def tile_count(self):
+        size_x, size_y = self.info['levels'][self.level]
+        tile_w, tile_h = self.info['tile_size']
+        planes = len(self.channels) * (self.z_range[1] - self.z_range[0]) * (self.t_range[1] - self.t_range[0])
+        return planes * (-(-size_x // tile_w)) * (-(-size_y // tile_h))
+
+    def _create_group(self, path):
+        dtype = np.dtype(PIXEL_TYPES[self.info['pixel_type']]).newbyteorder('<')
+        tile_w, tile_h = self.info['tile_size']
+        root = zarr.open_group(str(path), mode='w-')  # never overwrite existing data
+        array = root.create_dataset(
+            '0', shape=self.shape(), chunks=(1, 1, 1, tile_h, tile_w),
+            dtype=dtype, dimension_separator='/')
+
+        # Physical sizes of the exported level, in micrometers
+        full_x, full_y = self.info['levels'][0]
+        size_x, size_y = self.info['levels'][self.level]
+        pz, py, px = (s or 1.0 for s in self.info['physical_size'])
+        scale = [1.0, 1.0, pz, py * full_y / size_y, px * full_x / size_x]
+        root.attrs['multiscales'] = [{
+            'version': '0.4',
+            'name': self.info['name'],
+            'axes': [
+                {'name': 't', 'type': 'time'},
+                {'name': 'c', 'type': 'channel'},
+                {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+                {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                {'name': 'x', 'type': 'space', 'unit': 'micrometer'},
+            ],
+            'datasets': [{
+                'path': '0',
+                'coordinateTransformations': [{'type': 'scale', 'scale': scale}],
+            }],
+        }]
+        root.attrs['omero'] = {
+            'name': self.info['name'],
+            'channels': [{'label': self.info['channels'][c], 'active': True} for c in self.channels],
+        }
+        return array
+
+    def export_generator(self, conn, path, group_id=omero_connection.ALL_GROUPS, workers=8,
+                         limiter=None):
+        """Writes the OME-Zarr, yields (tiles written, total tiles).
+
+        A BandwidthLimiter, if given, makes the workers wait between tiles.
+        """
+        array = self._create_group(path)
+        dtype = np.dtype(PIXEL_TYPES[self.info['pixel_type']])
+        channel_index = {c: i for i, c in enumerate(self.channels)}
+        z0, t0 = self.z_range[0], self.t_range[0]
+        total = self.tile_count()
+
+        # RawPixelsStore is stateful, every worker thread gets its own
+        local = threading.local()
+        stores = []
+        stores_lock = threading.Lock()
+
+        def fetch(tile):
+            store = getattr(local, 'store', None)
+            if store is None:
+                store = conn.create_raw_pixels_store(self.info['pixels_id'], self.level, group_id)
+                local.store = store
+                with stores_lock:
+                    stores.append(store)
+            z, c, t, x, y, w, h = tile
+            data = store.getTile(z, c, t, x, y, w, h)
+            if limiter is not None:
+                limiter.wait(len(data))
+            return tile, data
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            tiles = self.tiles()
+            pending = set()
+            written = 0
+            yield written, total
+            while True:
+                # Keep a bounded number of tiles in flight, not the whole image in memory
+                while len(pending) < 2 * workers:
+                    tile = next(tiles, None)
+                    if tile is None:
+                        break
+                    pending.add(executor.submit(fetch, tile))
+                if not pending:
+                    break
+                # Short timeout: this runs on the GUI thread, which must stay responsive
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (z, c, t, x, y, w, h), data = future.result()
+                    plane = np.frombuffer(data, dtype=dtype).reshape(h, w)
+                    array[t - t0, channel_index[c], z - z0, y:y + h, x:x + w] = plane
+                    written += 1
+                yield written, total
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for store in stores:
+                store.close()